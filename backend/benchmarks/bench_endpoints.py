@@ -0,0 +1,295 @@
+"""
+Latency benchmark for every endpoint in main.py, with Ollama replayed from a cassette.
+
+The app runs in-process behind httpx.ASGITransport against a throwaway SQLite
+database, and OllamaClient talks to a cassette.ReplayTransport instead of a
+model. By default a cassette is synthesized with exact request keys: JSON
+answers for character/outline/plan generation (including the n=3 candidate
+options) and a token stream for chapter expansion. Pass --cassette to replay
+traffic recorded from a real model (OLLAMA_CASSETTE_MODE=record).
+
+--speed scales the recorded delays (1.0 original, 0 no delay), so the numbers
+either include realistic model timing or isolate the app's own overhead.
+Streaming endpoints also report time to the first SSE frame.
+
+Replay is strict: a request that matches no recorded interaction fails, so a
+changed prompt or payload is reported instead of replaying another recording.
+Exits with status 1 when a request fails (HTTP error or an SSE error frame) or,
+at --speed 0, when an endpoint's median exceeds its budget in BUDGETS_MS times
+--budget-scale, so it can gate regressions.
+
+Usage (from the backend directory):
+    python benchmarks/bench_endpoints.py [--iterations 20] [--speed 0] [--cassette PATH]
+                                         [--budget-scale 1.0] [--profile]
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKDIR = tempfile.mkdtemp(prefix="bench_endpoints_")
+
+CHARACTER = {
+    "name": "林远",
+    "age": 28,
+    "personality": "沉稳",
+    "family_background": "没落世家",
+    "social_class": "士族",
+    "growth_experiences": "少年离家",
+    "education_and_culture": "饱读诗书",
+    "profession_and_skills": "幕僚",
+    "inner_conflict": "忠义两难",
+}
+OUTLINE = {
+    "story_theme": "忠诚与背叛",
+    "core_conflict": "主角在旧主与新君之间抉择",
+    "character_relationships": "林远与旧主情同父子",
+    "world_setting": "王朝末年，诸侯割据",
+    "plot_structure": ["开端", "发展", "高潮", "结局"],
+    "abstract_outline": "一个幕僚在乱世中寻找自己的立场。",
+}
+PLAN = {
+    "chapters": [
+        {"index": i, "position": "发展", "dramatic_goal": f"第{i}章目标", "inner_conflict_display": "犹豫", "summary": "宫宴之后。"}
+        for i in range(1, 4)
+    ]
+}
+EXPANSION = "夜色深沉，宫墙高耸，烛光如溺星沉落。林远独立廊下，" * 20
+USAGE = {
+    "prompt_eval_count": 420,
+    "eval_count": 380,
+    "total_duration": 9_000_000_000,
+    "prompt_eval_duration": 600_000_000,
+    "eval_duration": 8_000_000_000,
+}
+
+CHARACTER_REQUEST = {"theme": "乱世", "prompt_question": "一个忠诚的幕僚"}
+OUTLINE_REQUEST = {"theme": "乱世", "style": "历史", "characters": [CHARACTER]}
+PLAN_REQUEST = {"outline": OUTLINE, "chapter_count": 3}
+EXPAND_REQUEST = {"chapter_summary": "宫宴之后，林远被迫表态。", "characters": [CHARACTER], "style": "历史"}
+CANDIDATES = 3
+
+# OllamaClient.stream_generate reports upstream errors (e.g. an unmatched replay) as text
+UPSTREAM_ERROR_TEXT = b"Could not connect to Ollama"
+
+# Median budgets at --speed 0, i.e. the app's own overhead per request
+GENERATION_BUDGET_MS = 60.0
+EXPANSION_BUDGET_MS = 200.0
+CRUD_BUDGET_MS = 60.0
+BUDGETS_MS = {
+    "POST /character/generate": GENERATION_BUDGET_MS,
+    "POST /character/generate n=3": GENERATION_BUDGET_MS,
+    "POST /character/generate n=3 stream": GENERATION_BUDGET_MS,
+    "POST /story/outline": GENERATION_BUDGET_MS,
+    "POST /story/chapters": GENERATION_BUDGET_MS,
+    "POST /story/expand": EXPANSION_BUDGET_MS,
+}
+
+
+def json_interaction(key: str, answer: dict, delay_ms: float) -> dict:
+    body = {"model": "bench", "response": json.dumps(answer, ensure_ascii=False), "done": True, **USAGE}
+    return {
+        "key": key, "method": "POST", "path": "/api/generate", "stream": False,
+        "status": 200, "content_type": "application/json",
+        "header_delay_ms": delay_ms, "lines": [[0.0, json.dumps(body, ensure_ascii=False)]],
+    }
+
+
+def stream_interaction(key: str, text: str, prefill_ms: float, token_ms: float) -> dict:
+    tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+    lines = [
+        [prefill_ms if i == 0 else token_ms, json.dumps({"response": token, "done": False}, ensure_ascii=False) + "\n"]
+        for i, token in enumerate(tokens)
+    ]
+    lines.append([token_ms, json.dumps({"response": "", "done": True, **USAGE}) + "\n"])
+    return {
+        "key": key, "method": "POST", "path": "/api/generate", "stream": True,
+        "status": 200, "content_type": "application/x-ndjson",
+        "header_delay_ms": 5.0, "lines": lines,
+    }
+
+
+def synthesize_cassette(path: str) -> None:
+    """Writes a cassette whose keys match the prompts this benchmark sends."""
+    import cassette, schemas, services
+    from config import settings
+
+    client = services.OllamaClient(settings.OLLAMA_API_BASE_URL, settings.OLLAMA_MODEL_NAME)
+
+    def key(prompt: str, stream: bool, options=None) -> str:
+        payload = client.build_payload(prompt, stream=stream, options=options)
+        return cassette.request_key("POST", "/api/generate", json.dumps(payload).encode("utf-8"))
+
+    prompts = [
+        (services.build_character_prompt(schemas.CharacterGenerateRequest(**CHARACTER_REQUEST)), CHARACTER, 900.0),
+        (services.build_story_outline_prompt(schemas.StoryOutlineRequest(**OUTLINE_REQUEST)), OUTLINE, 1500.0),
+        (services.build_chapter_plan_prompt(schemas.ChapterPlanRequest(**PLAN_REQUEST)), PLAN, 2000.0),
+    ]
+    interactions = []
+    for prompt, answer, delay_ms in prompts:
+        interactions.append(json_interaction(key(prompt, False), answer, delay_ms))
+        for index in range(CANDIDATES):
+            # Seeds are random per request and not part of the key
+            interactions.append(json_interaction(key(prompt, False, services.candidate_options(index, 1)), answer, delay_ms))
+    expand_prompt = services.build_expansion_prompt(schemas.StoryExpandRequest(**EXPAND_REQUEST))
+    interactions.append(stream_interaction(key(expand_prompt, True), EXPANSION, prefill_ms=400.0, token_ms=25.0))
+    cassette.write_cassette(path, interactions)
+
+
+async def timed(client, method: str, url: str, body=None):
+    """Returns (status, total seconds, seconds to the first body chunk, body)."""
+    start = time.perf_counter()
+    first = None
+    chunks = []
+    async with client.stream(method, url, json=body) as response:
+        async for chunk in response.aiter_raw():
+            if first is None:
+                first = time.perf_counter() - start
+            chunks.append(chunk)
+        status = response.status_code
+    return status, time.perf_counter() - start, first, b"".join(chunks)
+
+
+async def run(iterations: int):
+    import httpx
+    import main
+
+    results = {}
+    failures = []
+
+    async def measure(name: str, method: str, url_for, body=None):
+        samples, firsts = [], []
+        for i in range(iterations):
+            status, total, first, content = await timed(client, method, url_for(i), body)
+            if status >= 400:
+                failures.append(f"{name}: HTTP {status} {content[:200].decode('utf-8', errors='replace')}")
+            elif content.startswith(b"data:") and (b'"error"' in content or UPSTREAM_ERROR_TEXT in content):
+                failures.append(f"{name}: error in the stream")
+            samples.append(total)
+            if first is not None:
+                firsts.append(first)
+        results[name] = (samples, firsts)
+
+    # Unhandled errors become 500 responses, reported as failures below
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        project = (await client.post("/projects/", json={"name": "bench"})).json()
+        pid = project["id"]
+        for i in range(20):
+            await client.post(f"/projects/{pid}/characters/", json={"data": dict(CHARACTER, name=f"角色{i}")})
+        chapter_ids = []
+        for chapter in PLAN["chapters"]:
+            saved = (await client.post(f"/projects/{pid}/chapters/", json={
+                "plan_data": chapter, "chapter_index": chapter["index"], "content": EXPANSION,
+            })).json()
+            chapter_ids.append(saved["id"])
+        await client.post(f"/projects/{pid}/story_outline/", json={"data": OUTLINE})
+        # Fresh projects for the outline POST, which is create-once per project
+        outline_pids = [
+            (await client.post("/projects/", json={"name": f"outline {i}"})).json()["id"] for i in range(iterations)
+        ]
+
+        def with_project(body: dict) -> dict:
+            return dict(body, project_id=pid)
+
+        await measure("POST /character/generate", "POST", lambda i: "/character/generate", with_project(CHARACTER_REQUEST))
+        await measure("POST /character/generate n=3", "POST", lambda i: "/character/generate",
+                      with_project(dict(CHARACTER_REQUEST, n=CANDIDATES)))
+        await measure("POST /character/generate n=3 stream", "POST", lambda i: "/character/generate",
+                      with_project(dict(CHARACTER_REQUEST, n=CANDIDATES, stream=True)))
+        await measure("POST /story/outline", "POST", lambda i: "/story/outline", with_project(OUTLINE_REQUEST))
+        await measure("POST /story/chapters", "POST", lambda i: "/story/chapters", with_project(PLAN_REQUEST))
+        await measure("POST /story/expand", "POST", lambda i: "/story/expand",
+                      dict(EXPAND_REQUEST, chapter_id=chapter_ids[0]))
+        await measure("GET /speculation/stats", "GET", lambda i: "/speculation/stats")
+        await measure("POST /projects/", "POST", lambda i: "/projects/", {"name": "bench"})
+        await measure("GET /projects/", "GET", lambda i: "/projects/")
+        await measure("GET /projects/{id}", "GET", lambda i: f"/projects/{pid}")
+        await measure("POST /projects/{id}/characters/", "POST", lambda i: f"/projects/{pid}/characters/", {"data": CHARACTER})
+        await measure("GET /projects/{id}/characters/", "GET", lambda i: f"/projects/{pid}/characters/?min_age=20")
+        await measure("POST /projects/{id}/story_outline/", "POST", lambda i: f"/projects/{outline_pids[i]}/story_outline/",
+                      {"data": OUTLINE})
+        await measure("GET /projects/{id}/story_outline/", "GET", lambda i: f"/projects/{pid}/story_outline/")
+        await measure("POST /projects/{id}/chapters/", "POST", lambda i: f"/projects/{pid}/chapters/",
+                      {"plan_data": PLAN["chapters"][0], "chapter_index": 99})
+        await measure("GET /projects/{id}/chapters/", "GET", lambda i: f"/projects/{pid}/chapters/")
+        await measure("GET /projects/{id}/duplicates", "GET", lambda i: f"/projects/{pid}/duplicates")
+        await measure("GET /projects/{id}/usage", "GET", lambda i: f"/projects/{pid}/usage")
+        await measure("PUT /chapters/{id}", "PUT", lambda i: f"/chapters/{chapter_ids[-1]}", {"content": EXPANSION})
+        await measure("GET /characters/", "GET", lambda i: "/characters/")
+        await measure("GET /", "GET", lambda i: "/")
+    return results, failures
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:9.2f}"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--speed", type=float, default=0.0, help="replay speed; 0 replays without delays")
+    parser.add_argument("--cassette", help="replay this recorded cassette instead of a synthesized one")
+    parser.add_argument("--budget-scale", type=float, default=float(os.environ.get("ENDPOINT_BUDGET_SCALE", 1.0)),
+                        help="multiplies every budget, e.g. for slower CI machines")
+    parser.add_argument("--profile", action="store_true", help="print the top functions by cumulative time")
+    args = parser.parse_args()
+
+    cassette_path = args.cassette or os.path.join(WORKDIR, "ollama.jsonl.gz")
+    os.environ.update({
+        "OLLAMA_CASSETTE_MODE": "replay",
+        "OLLAMA_CASSETTE_PATH": os.path.abspath(cassette_path),
+        "OLLAMA_REPLAY_SPEED": str(args.speed),
+        "SHARED_STATE_BACKEND": "local",
+        "CLIENT_RATE_LIMIT_PER_MINUTE": "0",
+        "RESPONSE_CACHE_TTL_SECONDS": "0",
+        "SPECULATIVE_EXPANSION": "false",
+    })
+
+    import database
+    database.SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(WORKDIR, 'bench.db')}"
+    database.init_db()
+    if not args.cassette:
+        synthesize_cassette(cassette_path)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    results, failures = asyncio.run(run(args.iterations))
+    if profiler:
+        profiler.disable()
+
+    print(f"{args.iterations} iterations, replay speed {args.speed}, cassette {cassette_path}")
+    check_budgets = args.speed == 0
+    print(f"{'endpoint':<40} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'first ms':>9} {'budget':>9}")
+    over_budget = False
+    for name, (samples, firsts) in results.items():
+        ordered = sorted(samples)
+        median = statistics.median(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        first = ms(statistics.median(firsts)) if firsts else f"{'-':>9}"
+        budget = BUDGETS_MS.get(name, CRUD_BUDGET_MS) * args.budget_scale / 1000
+        over = check_budgets and median > budget
+        over_budget = over_budget or over
+        print(f"{name:<40} {ms(statistics.mean(samples))} {ms(median)} {ms(p95)} {first} {ms(budget)}"
+              f"{'  OVER BUDGET' if over else ''}")
+    if not check_budgets:
+        print("Budgets apply to --speed 0 only; not checked.")
+    for failure in failures:
+        print(f"FAILED {failure}")
+
+    if profiler:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    return 1 if failures or over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Microbenchmark for response and SSE frame encoding.
+
+Compares, per chapter listing and per SSE frame:
+  - default: ORM object -> schemas.Chapter (from_attributes) -> jsonable_encoder -> json.dumps
+  - fast:    plain row dict -> serialization.dumps (orjson when installed)
+  - SSE:     f-string + json.dumps(ensure_ascii=False) vs serialization.sse_chunk
+
+Usage (from the backend directory):
+    python benchmarks/bench_serialization.py [--chapters 200] [--repeat 50]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+
+import models, schemas, serialization
+
+PLAN = {
+    "position": "冲突",
+    "dramatic_goal": "主角在朝堂上被迫表态",
+    "inner_conflict_display": "在忠诚与自保之间犹豫，言辞闪烁",
+    "summary": "宫宴之后，" * 40,
+}
+CONTENT = "夜色深沉，宫墙高耸，烛光如溺星沉落。" * 300
+
+
+def make_chapters(count: int):
+    return [
+        models.Chapter(id=i, project_id=1, chapter_index=i, plan_data=dict(PLAN, index=i), content=CONTENT)
+        for i in range(1, count + 1)
+    ]
+
+
+def to_row(chapter) -> dict:
+    return {
+        "id": chapter.id,
+        "project_id": chapter.project_id,
+        "chapter_index": chapter.chapter_index,
+        "plan_data": chapter.plan_data,
+        "content": chapter.content,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chapters", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    chapters = make_chapters(args.chapters)
+    rows = [to_row(chapter) for chapter in chapters]
+
+    def default_path():
+        validated = [schemas.Chapter.model_validate(chapter, from_attributes=True) for chapter in chapters]
+        return json.dumps(jsonable_encoder(validated), ensure_ascii=False).encode("utf-8")
+
+    def fast_path():
+        return serialization.dumps(rows)
+
+    assert json.loads(default_path()) == json.loads(fast_path())
+
+    backend = "orjson" if serialization.orjson is not None else "stdlib json"
+    print(f"encoder: {backend}")
+    print(f"chapter list ({args.chapters} chapters, {len(fast_path()) / 1024:.0f} KiB):")
+    default_s = min(timeit.repeat(default_path, number=1, repeat=args.repeat))
+    fast_s = min(timeit.repeat(fast_path, number=1, repeat=args.repeat))
+    print(f"  default  {default_s * 1000:9.3f} ms/list")
+    print(f"  fast     {fast_s * 1000:9.3f} ms/list  ({default_s / fast_s:.1f}x)")
+
+    token = "烛光如溺星沉落。"
+
+    def sse_default():
+        return f"data: {json.dumps({'chunk': token}, ensure_ascii=False)}\n\n"
+
+    def sse_fast():
+        return serialization.sse_chunk(token)
+
+    assert json.loads(sse_default()[6:]) == json.loads(sse_fast()[6:])
+
+    print(f"SSE frame ({args.frames} frames):")
+    default_f = min(timeit.repeat(sse_default, number=args.frames, repeat=5)) / args.frames
+    fast_f = min(timeit.repeat(sse_fast, number=args.frames, repeat=5)) / args.frames
+    print(f"  default  {default_f * 1e6:9.3f} us/frame")
+    print(f"  fast     {fast_f * 1e6:9.3f} us/frame  ({default_f / fast_f:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
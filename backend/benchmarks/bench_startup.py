@@ -0,0 +1,71 @@
+"""
+Import-time and cold-start benchmark for the API.
+
+Measures, over several fresh processes:
+  - import time: `python -c "import main"`
+  - cold start:  process start of `uvicorn main:app` until the first successful `GET /`
+
+Exits with status 1 when the median of either measurement exceeds its budget,
+so it can gate deployments where the autoscaler starts workers frequently.
+The processes use a throwaway database (DATABASE_URL), never novelaicreator.db.
+
+Usage (from the backend directory):
+    python benchmarks/bench_startup.py [--runs 5] [--import-budget 1.5] [--startup-budget 3.0]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from common import BACKEND_DIR, free_port, start_uvicorn, stop, wait_until_ready
+
+
+def measure_import(env: Dict[str, str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=BACKEND_DIR, env={**os.environ, **env}, check=True)
+    return time.perf_counter() - start
+
+
+def measure_cold_start(timeout: float, env: Dict[str, str]) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    proc = start_uvicorn("main:app", port, env=env)
+    try:
+        wait_until_ready(proc, f"http://127.0.0.1:{port}/", timeout)
+        return time.perf_counter() - start
+    finally:
+        stop(proc)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--import-budget", type=float, default=float(os.environ.get("IMPORT_BUDGET_SECONDS", 1.5)))
+    parser.add_argument("--startup-budget", type=float, default=float(os.environ.get("STARTUP_BUDGET_SECONDS", 3.0)))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {"DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'startup.db')}"}
+        import_times = [measure_import(env) for _ in range(args.runs)]
+        startup_times = [measure_cold_start(args.startup_budget * 5, env) for _ in range(args.runs)]
+
+    failed = False
+    for label, samples, budget in (
+        ("import", import_times, args.import_budget),
+        ("cold start", startup_times, args.startup_budget),
+    ):
+        median = statistics.median(samples)
+        status = "OK" if median <= budget else "OVER BUDGET"
+        failed = failed or median > budget
+        print(f"{label:>10}: median {median * 1000:7.1f} ms  "
+              f"min {min(samples) * 1000:7.1f} ms  max {max(samples) * 1000:7.1f} ms  "
+              f"budget {budget * 1000:7.1f} ms  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
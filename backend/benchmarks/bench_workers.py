@@ -0,0 +1,122 @@
+"""
+Multi-worker benchmark for the shared state backend.
+
+For 1, 2, 4 and 8 uvicorn workers (SHARED_STATE_BACKEND=sqlite) it measures:
+  - CRUD throughput: concurrent `GET /projects/` for a fixed duration
+  - the global upstream limit: peak concurrent requests seen by a stub Ollama
+    while a burst of `/character/generate` requests is in flight
+  - the per-client rate limit: how many requests of the burst were admitted
+
+Exits with status 1 if either limit is exceeded with any worker count.
+Every run uses a throwaway application database seeded with SEED_PROJECTS projects.
+The stub upstream (benchmarks/stub_ollama.py) is started automatically.
+
+Usage (from the backend directory):
+    python benchmarks/bench_workers.py [--workers 1 2 4 8] [--duration 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+from common import free_port, start_uvicorn, stop, wait_until_ready
+
+UPSTREAM_LIMIT = 2
+RATE_LIMIT = 40
+CHARACTER_REQUEST = {"theme": "古风", "prompt_question": "一位谋士"}
+SEED_PROJECTS = 20
+
+
+def seed_projects(base_url: str) -> None:
+    with httpx.Client(timeout=30.0) as client:
+        for i in range(SEED_PROJECTS):
+            client.post(f"{base_url}/projects/", json={"name": f"项目{i}", "description": "基准测试"}).raise_for_status()
+
+
+async def crud_throughput(base_url: str, duration: float, concurrency: int) -> float:
+    done = 0
+    deadline = time.perf_counter() + duration
+
+    async def loop(client: httpx.AsyncClient):
+        nonlocal done
+        while time.perf_counter() < deadline:
+            response = await client.get(f"{base_url}/projects/")
+            response.raise_for_status()
+            done += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=30.0, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(loop(client) for _ in range(concurrency)))
+        return done / (time.perf_counter() - start)
+
+
+async def generation_burst(base_url: str, count: int) -> dict:
+    async with httpx.AsyncClient(timeout=120.0, limits=httpx.Limits(max_connections=count)) as client:
+        responses = await asyncio.gather(
+            *(client.post(f"{base_url}/character/generate", json=CHARACTER_REQUEST) for _ in range(count))
+        )
+    statuses = {}
+    for response in responses:
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    return statuses
+
+
+def run(workers: int, stub_url: str, duration: float, concurrency: int) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            "OLLAMA_API_BASE_URL": stub_url,
+            "SHARED_STATE_BACKEND": "sqlite",
+            "SHARED_STATE_PATH": os.path.join(tmp, "shared_state.db"),
+            "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'app.db')}",
+            "UPSTREAM_CONCURRENCY_LIMIT": str(UPSTREAM_LIMIT),
+            "CLIENT_RATE_LIMIT_PER_MINUTE": str(RATE_LIMIT),
+            "RESPONSE_CACHE_TTL_SECONDS": "0",
+        }
+        proc = start_uvicorn("main:app", port, ["--workers", str(workers)], env)
+        try:
+            wait_until_ready(proc, f"{base_url}/", timeout=30.0)
+            seed_projects(base_url)
+            throughput = asyncio.run(crud_throughput(base_url, duration, concurrency))
+            httpx.post(f"{stub_url}/stats/reset")
+            statuses = asyncio.run(generation_burst(base_url, RATE_LIMIT + 10))
+            peak = httpx.get(f"{stub_url}/stats").json()["max_in_flight"]
+        finally:
+            stop(proc)
+    return {"throughput": throughput, "peak_upstream": peak, "admitted": statuses.get(200, 0), "statuses": statuses}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    stub = start_uvicorn("benchmarks.stub_ollama:app", stub_port)
+    failed = False
+    try:
+        wait_until_ready(stub, f"{stub_url}/stats", timeout=30.0)
+        print(f"{'workers':>7} {'CRUD req/s':>11} {'peak upstream':>14} {'admitted':>9}  statuses")
+        for workers in args.workers:
+            result = run(workers, stub_url, args.duration, args.concurrency)
+            over = result["peak_upstream"] > UPSTREAM_LIMIT or result["admitted"] > RATE_LIMIT
+            failed = failed or over
+            print(f"{workers:>7} {result['throughput']:>11.1f} "
+                  f"{result['peak_upstream']:>8} / {UPSTREAM_LIMIT:<3} {result['admitted']:>4} / {RATE_LIMIT:<3} "
+                  f"{result['statuses']}{'  LIMIT EXCEEDED' if over else ''}")
+    finally:
+        stop(stub)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
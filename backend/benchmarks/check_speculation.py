@@ -0,0 +1,141 @@
+"""
+End-to-end check of speculative expansion, with Ollama replayed from a cassette.
+
+Runs the sequence the chapter expansion page produces and asserts on
+/speculation/stats:
+  1. expand chapter 1, save it (PUT /chapters/{id}), expand chapter 2:
+     chapter 2 is served from the speculative buffer (1 hit, nothing discarded);
+  2. with UPSTREAM_CONCURRENCY_LIMIT=1, a foreground request that arrives while
+     chapter 3 is being generated speculatively preempts it and does not wait
+     for the whole speculative stream;
+  3. a request for a chapter whose speculation has not started yet (another
+     generation is in flight) is a miss and is generated live right away.
+
+Usage (from the backend directory):
+    python benchmarks/check_speculation.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_endpoints import CHARACTER, CHARACTER_REQUEST, EXPANSION, WORKDIR, json_interaction, stream_interaction
+
+CASSETTE = os.path.join(WORKDIR, "speculation.jsonl")
+# One token every TOKEN_MS; the expansion stream takes about len(EXPANSION) / 4 * TOKEN_MS
+TOKEN_MS = 10.0
+STYLE = "历史"
+
+
+def chapter_plan(index: int) -> dict:
+    return {"index": index, "position": "发展", "dramatic_goal": f"第{index}章目标", "summary": f"第{index}章：宫宴之后。"}
+
+
+async def read_sse(client, body: dict) -> str:
+    response = await client.post("/story/expand", json=body)
+    assert response.status_code == 200, response.text
+    return response.text
+
+
+async def wait_for(predicate, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for speculation")
+        await asyncio.sleep(0.01)
+
+
+async def run() -> None:
+    import httpx
+    import main, services
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://check", timeout=30.0) as client:
+        pid = (await client.post("/projects/", json={"name": "speculation"})).json()["id"]
+        await client.post(f"/projects/{pid}/characters/", json={"data": CHARACTER})
+        chapter_ids = []
+        for index in (1, 2, 3):
+            saved = (await client.post(f"/projects/{pid}/chapters/", json={
+                "plan_data": chapter_plan(index), "chapter_index": index,
+            })).json()
+            chapter_ids.append(saved["id"])
+
+        def expand_request(position: int) -> dict:
+            return {
+                "chapter_summary": chapter_plan(position + 1)["summary"],
+                "characters": [CHARACTER],
+                "style": STYLE,
+                "chapter_id": chapter_ids[position],
+            }
+
+        # 1. expand, save, expand the next chapter
+        await read_sse(client, expand_request(0))
+        await client.put(f"/chapters/{chapter_ids[0]}", json={"content": EXPANSION})
+        await wait_for(lambda: chapter_ids[1] in services.speculation.entries
+                       and services.speculation.entries[chapter_ids[1]].started_at is not None)
+        await read_sse(client, expand_request(1))
+        stats = (await client.get("/speculation/stats")).json()
+        assert stats["hits"] == 1 and stats["discarded"] == 0, stats
+        print(f"save then expand: {stats}")
+
+        # 2. chapter 3 is now generating speculatively and holds the only slot
+        await wait_for(lambda: chapter_ids[2] in services.speculation.entries
+                       and services.speculation.entries[chapter_ids[2]].started_at is not None)
+        start = time.perf_counter()
+        response = await client.post("/character/generate", json=CHARACTER_REQUEST)
+        waited = time.perf_counter() - start
+        assert response.status_code == 200, response.text
+        stats = (await client.get("/speculation/stats")).json()
+        stream_seconds = len(EXPANSION) / 4 * TOKEN_MS / 1000
+        assert stats["preempted"] == 1, stats
+        assert waited < stream_seconds / 2, f"foreground waited {waited:.2f}s behind a {stream_seconds:.2f}s stream"
+        print(f"preemption: foreground answered in {waited * 1000:.0f} ms; {stats}")
+
+        # 3. stands in for a generation in flight on another request, so the
+        # speculation scheduled after chapter 2 stays queued
+        services.speculation.foreground_started()
+        try:
+            await read_sse(client, expand_request(1))
+            await wait_for(lambda: chapter_ids[2] in services.speculation.entries)
+            assert services.speculation.entries[chapter_ids[2]].started_at is None
+            start = time.perf_counter()
+            await read_sse(client, expand_request(2))
+            waited = time.perf_counter() - start
+        finally:
+            services.speculation.foreground_finished()
+        stats = (await client.get("/speculation/stats")).json()
+        assert stats["hits"] == 1 and stats["misses"] == 3 and stats["buffered"] == 0, stats
+        assert waited < stream_seconds * 2, f"queued speculation made the request wait {waited:.2f}s"
+        print(f"unstarted speculation: served live in {waited * 1000:.0f} ms; {stats}")
+
+
+def main() -> int:
+    os.environ.update({
+        "OLLAMA_CASSETTE_MODE": "replay",
+        "OLLAMA_CASSETTE_PATH": CASSETTE,
+        "OLLAMA_REPLAY_SPEED": "1.0",
+        # Every expansion prompt differs; one recorded stream serves them all
+        "OLLAMA_REPLAY_STRICT": "false",
+        "SHARED_STATE_BACKEND": "local",
+        "UPSTREAM_CONCURRENCY_LIMIT": "1",
+        "SPECULATIVE_EXPANSION": "true",
+        "CLIENT_RATE_LIMIT_PER_MINUTE": "0",
+    })
+    import cassette, database
+
+    # Unmatched requests fall back to the interaction with the same shape (non-strict replay)
+    cassette.write_cassette(CASSETTE, [
+        json_interaction("character", CHARACTER, delay_ms=50.0),
+        stream_interaction("expansion", EXPANSION, prefill_ms=50.0, token_ms=TOKEN_MS),
+    ])
+    database.SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(WORKDIR, 'speculation.db')}"
+    database.init_db()
+    asyncio.run(run())
+    print("ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
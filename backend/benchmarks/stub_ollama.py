@@ -0,0 +1,69 @@
+"""
+Minimal stand-in for the Ollama `/api/generate` endpoint used by the benchmarks.
+
+It sleeps for STUB_LATENCY_SECONDS per request, answers with a valid character
+profile (or a short token stream), and tracks how many requests were in flight
+at once so the benchmarks can check the global upstream limit.
+
+Run with: uvicorn benchmarks.stub_ollama:app --port 11500
+"""
+import asyncio
+import json
+import os
+
+from fastapi import FastAPI, Request
+from starlette.responses import StreamingResponse
+
+LATENCY_SECONDS = float(os.environ.get("STUB_LATENCY_SECONDS", "0.2"))
+
+CHARACTER = {
+    "name": "林远",
+    "age": 28,
+    "personality": "沉稳",
+    "family_background": "没落世家",
+    "social_class": "士族",
+    "growth_experiences": "少年离家",
+    "education_and_culture": "饱读诗书",
+    "profession_and_skills": "幕僚",
+    "inner_conflict": "忠义两难",
+}
+
+app = FastAPI()
+stats = {"in_flight": 0, "max_in_flight": 0, "requests": 0}
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+
+    if not body.get("stream"):
+        try:
+            await asyncio.sleep(LATENCY_SECONDS)
+        finally:
+            stats["in_flight"] -= 1
+        return {"response": json.dumps(CHARACTER, ensure_ascii=False), "done": True}
+
+    async def lines():
+        try:
+            for _ in range(20):
+                await asyncio.sleep(LATENCY_SECONDS / 20)
+                yield json.dumps({"response": "夜色深沉。", "done": False}, ensure_ascii=False) + "\n"
+            yield json.dumps({"response": "", "done": True}) + "\n"
+        finally:
+            stats["in_flight"] -= 1
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/stats")
+def read_stats():
+    return stats
+
+
+@app.post("/stats/reset")
+def reset_stats():
+    stats.update(in_flight=0, max_in_flight=0, requests=0)
+    return stats
@@ -0,0 +1,218 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+# --------------------------------------------------------------------------
+# Record/replay transport for the httpx client used by OllamaClient.
+#
+# Cassette format: JSON Lines (gzip-compressed when the path ends in .gz), one
+# interaction per line:
+#   {"key": sha256 of method + path + canonical JSON body (without options.seed),
+#    "method": "POST", "path": "/api/generate", "stream": true,
+#    "status": 200, "content_type": "application/x-ndjson",
+#    "header_delay_ms": 812.4,              # request sent -> response headers
+#    "lines": [[delay_ms, "line\n"], ...]}  # delay since the previous event
+# --------------------------------------------------------------------------
+
+def request_key(method: str, path: str, body: bytes) -> str:
+    """
+    Identifies a request independently of JSON key order and whitespace.
+    Sampling seeds are drawn per request, so `options.seed` is not part of the key.
+    """
+    try:
+        data = json.loads(body or b"null")
+        if isinstance(data, dict) and isinstance(data.get("options"), dict):
+            data["options"] = {k: v for k, v in data["options"].items() if k != "seed"}
+        canonical = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        canonical = body.decode("utf-8", errors="replace")
+    return hashlib.sha256(f"{method} {path} {canonical}".encode("utf-8")).hexdigest()
+
+
+def _is_stream(body: bytes) -> bool:
+    try:
+        return bool(json.loads(body or b"null").get("stream"))
+    except (ValueError, AttributeError):
+        return False
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def load_cassette(path: str) -> List[Dict[str, Any]]:
+    with _open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# --------------------------------------------------------------------------
+# Recording
+# --------------------------------------------------------------------------
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """Passes the upstream body through, timing each complete line."""
+
+    def __init__(self, inner: httpx.AsyncByteStream, interaction: Dict[str, Any], on_close):
+        self._inner = inner
+        self._interaction = interaction
+        self._on_close = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        lines = self._interaction["lines"]
+        buffer = b""
+        last = time.perf_counter()
+        async for chunk in self._inner:
+            now = time.perf_counter()
+            buffer += chunk
+            *complete, buffer = buffer.split(b"\n")
+            for i, line in enumerate(complete):
+                # Lines arriving in the same network chunk share its delay
+                delay = (now - last) * 1000 if i == 0 else 0.0
+                lines.append([round(delay, 3), line.decode("utf-8") + "\n"])
+            if complete:
+                last = now
+            yield chunk
+        if buffer:
+            lines.append([round((time.perf_counter() - last) * 1000, 3), buffer.decode("utf-8")])
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+        self._on_close(self._interaction)
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Forwards requests to a real transport and appends each interaction to the cassette."""
+
+    def __init__(self, path: str, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self.path = path
+        self.inner = inner or httpx.AsyncHTTPTransport()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _write(self, interaction: Dict[str, Any]) -> None:
+        line = json.dumps(interaction, ensure_ascii=False, separators=(",", ":"))
+        with self._lock, _open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        # Recorded lines must be the decoded payload, not a compressed body
+        request.headers["Accept-Encoding"] = "identity"
+        start = time.perf_counter()
+        response = await self.inner.handle_async_request(request)
+        interaction = {
+            "key": request_key(request.method, request.url.path, body),
+            "method": request.method,
+            "path": request.url.path,
+            "stream": _is_stream(body),
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type", "application/json"),
+            "header_delay_ms": round((time.perf_counter() - start) * 1000, 3),
+            "lines": [],
+        }
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(response.stream, interaction, self._write),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        # OllamaClient opens a short-lived httpx client per call, and closing a client
+        # closes its transport; the inner transport is shared and must outlive them.
+        pass
+
+# --------------------------------------------------------------------------
+# Replay
+# --------------------------------------------------------------------------
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, lines: List[Tuple[float, str]], speed: float):
+        self._lines = lines
+        self._speed = speed
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for delay_ms, line in self._lines:
+            if self._speed > 0 and delay_ms > 0:
+                await asyncio.sleep(delay_ms / 1000 / self._speed)
+            yield line.encode("utf-8")
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    Serves recorded interactions without a model behind it.
+
+    `speed` scales the recorded delays: 1.0 replays at the original pace, 2.0
+    twice as fast, 0 without any delay. Requests are matched by their key, and
+    an unmatched request gets a 404, so a changed prompt or payload fails
+    instead of replaying another recording. With `strict=False` it falls back
+    to any interaction with the same method, path and stream flag, with a
+    warning. Repeated requests cycle through the matching interactions.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, strict: bool = True):
+        self.speed = speed
+        self.strict = strict
+        self._by_key: Dict[str, List[Dict[str, Any]]] = {}
+        self._by_shape: Dict[Tuple[str, str, bool], List[Dict[str, Any]]] = {}
+        self._counters: Dict[Any, int] = {}
+        for interaction in load_cassette(path):
+            self._by_key.setdefault(interaction["key"], []).append(interaction)
+            shape = (interaction["method"], interaction["path"], interaction["stream"])
+            self._by_shape.setdefault(shape, []).append(interaction)
+
+    def _next(self, pool_key: Any, pool: List[Dict[str, Any]]) -> Dict[str, Any]:
+        count = self._counters.get(pool_key, 0)
+        self._counters[pool_key] = count + 1
+        return pool[count % len(pool)]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = request_key(request.method, request.url.path, body)
+        if key in self._by_key:
+            interaction = self._next(key, self._by_key[key])
+        else:
+            shape = (request.method, request.url.path, _is_stream(body))
+            if self.strict or shape not in self._by_shape:
+                print(f"Cassette: no recorded interaction for {request.method} {request.url.path} (key {key[:12]})")
+                return httpx.Response(404, json={"error": f"no recorded interaction for {request.method} {request.url.path}"})
+            print(f"Cassette: no interaction with key {key[:12]}; replaying one for {request.method} {request.url.path}")
+            interaction = self._next(shape, self._by_shape[shape])
+
+        if self.speed > 0 and interaction["header_delay_ms"] > 0:
+            await asyncio.sleep(interaction["header_delay_ms"] / 1000 / self.speed)
+        return httpx.Response(
+            status_code=interaction["status"],
+            headers={"content-type": interaction["content_type"]},
+            stream=_ReplayStream(interaction["lines"], self.speed),
+        )
+
+
+def write_cassette(path: str, interactions: List[Dict[str, Any]]) -> None:
+    """Writes interactions (e.g. synthesized for benchmarks) as a cassette."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _open(path, "w") as f:
+        for interaction in interactions:
+            f.write(json.dumps(interaction, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def transport_from_settings(settings) -> Optional[httpx.AsyncBaseTransport]:
+    """Transport for OLLAMA_CASSETTE_MODE: 'record', 'replay', or '' for the network."""
+    mode = settings.OLLAMA_CASSETTE_MODE
+    if not mode:
+        return None
+    if mode == "record":
+        return RecordingTransport(settings.OLLAMA_CASSETTE_PATH)
+    if mode == "replay":
+        return ReplayTransport(
+            settings.OLLAMA_CASSETTE_PATH, speed=settings.OLLAMA_REPLAY_SPEED, strict=settings.OLLAMA_REPLAY_STRICT
+        )
+    raise ValueError(f"Unknown OLLAMA_CASSETTE_MODE '{mode}'")
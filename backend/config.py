@@ -7,11 +7,73 @@ class Settings(BaseSettings):
     # Ollama Configuration
     OLLAMA_API_BASE_URL: str = "http://127.0.0.1:11434"
     OLLAMA_MODEL_NAME: str = "llama3"
+    # Cassette record/replay of Ollama traffic: '' (off), 'record' or 'replay'
+    OLLAMA_CASSETTE_MODE: str = ""
+    OLLAMA_CASSETTE_PATH: str = "./cassettes/ollama.jsonl.gz"
+    # Replay speed: 1.0 original timing, >1 accelerated, 0 no delays
+    OLLAMA_REPLAY_SPEED: float = 1.0
+    # Unmatched requests fail; false replays any interaction of the same shape instead
+    OLLAMA_REPLAY_STRICT: bool = True
+
+    # Application database (projects, characters, chapters, usage)
+    DATABASE_URL: str = "sqlite:///./novelaicreator.db"
 
     # OpenAI Configuration
     OPENAI_API_KEY: str = "your_openai_api_key_here"
     OPENAI_MODEL_NAME: str = "gpt-4-turbo"
 
+    # Shared State Configuration (cache, concurrency and rate limits across workers)
+    # 'local' keeps state in-process (single worker); 'sqlite' shares it between
+    # all worker processes on the same machine through SHARED_STATE_PATH.
+    SHARED_STATE_BACKEND: str = "local"
+    SHARED_STATE_PATH: str = "./shared_state.db"
+    # Seconds a generated JSON response is reused for an identical prompt; 0 disables
+    RESPONSE_CACHE_TTL_SECONDS: int = 0
+    # Maximum concurrent requests to the AI provider, across all workers
+    UPSTREAM_CONCURRENCY_LIMIT: int = 4
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS: float = 120.0
+    # Slots are renewed while held; a crashed worker's slots free up after this long
+    UPSTREAM_SLOT_LEASE_SECONDS: float = 30.0
+    # Generation requests per client per minute; 0 disables
+    CLIENT_RATE_LIMIT_PER_MINUTE: int = 0
+
+    # Speculative Expansion: pre-generate the next chapter while the current one is reviewed
+    SPECULATIVE_EXPANSION: bool = False
+    SPECULATIVE_MAX_ENTRIES: int = 4
+
+    # Usage Accounting and Quotas (0 disables a quota)
+    PROJECT_TOKEN_QUOTA: int = 0
+    PROJECT_CONCURRENCY_LIMIT: int = 0
+    CLIENT_TOKEN_QUOTA_PER_HOUR: int = 0
+    CLIENT_CONCURRENCY_LIMIT: int = 0
+    # Usage aggregates are written every interval or after this many records
+    USAGE_FLUSH_INTERVAL_SECONDS: float = 5.0
+    USAGE_FLUSH_BATCH: int = 100
+
+    # Duplicate Detection: check streamed expansions for repetition loops and
+    # passages recycled from the project's other chapters
+    DEDUP_ENABLED: bool = True
+    # 'flag' sends a warning frame; 'stop' also ends the generation
+    DEDUP_ACTION: str = "flag"
+    DEDUP_OVERLAP_THRESHOLD: float = 0.5
+    DEDUP_LOOP_THRESHOLD: float = 0.6
+
+    # Request Tracing: when enabled, requests sent with `X-Trace: 1` are traced,
+    # plus a random TRACE_SAMPLE_RATE fraction (0-1) of all other requests
+    TRACING_ENABLED: bool = False
+    TRACE_SAMPLE_RATE: float = 0.0
+    # Traced requests slower than this are appended to TRACE_FILE (Chrome trace
+    # format); each worker writes its own file, e.g. slow_traces.<pid>.json
+    TRACE_SLOW_THRESHOLD_MS: float = 2000.0
+    TRACE_FILE: str = "./traces/slow_traces.json"
+    TRACE_FILE_MAX_BYTES: int = 10 * 1024 * 1024
+    TRACE_FILE_BACKUPS: int = 5
+    # Profile traced requests: '' (off), 'cprofile' (includes worker threads)
+    # or 'pyinstrument' (event loop thread only; if installed)
+    TRACE_PROFILER: str = ""
+    # Serve traces and profiles under /debug; keep off in production
+    DEBUG_ENDPOINTS_ENABLED: bool = False
+
     class Config:
         env_file = ".env"
         env_file_encoding = 'utf-8'
@@ -1,20 +1,88 @@
+from datetime import datetime
 from sqlalchemy.orm import Session
-import models, schemas
+from typing import Any, Dict, List, Optional
+import models, schemas, tracing
+
+# The *_rows functions below return plain dicts shaped like the response schemas.
+# They select only the needed columns and are serialized directly by the listing
+# endpoints, skipping the ORM -> Pydantic -> jsonable_encoder round trip.
+
+#================================================================#
+#                       Promoted Columns                         #
+#================================================================#
+
+# Fields copied out of the JSON payloads into typed, indexed columns so that
+# listings can filter in SQL. Keep in sync with migrations._promote_query_fields.
+
+def _as_int(value: Any) -> Optional[int]:
+    """
+    The value as an integer if it is a clean one (an int, an integral float or a
+    digit-only string), otherwise None. Matches migrations._json_int.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    if isinstance(value, str) and value and value.isascii() and value.isdigit():
+        return int(value)
+    return None
+
+def _as_str(value: Any) -> Optional[str]:
+    """The value if it is a string, otherwise None. Matches migrations._json_text."""
+    return value if isinstance(value, str) else None
+
+def _character_columns(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "name": _as_str(data.get("name")),
+        "age": _as_int(data.get("age")),
+        "social_class": _as_str(data.get("social_class")),
+    }
+
+def _chapter_columns(plan_data: Dict[str, Any], chapter_index: int) -> Dict[str, Any]:
+    plan_index = _as_int(plan_data.get("index"))
+    return {
+        # Falls back to chapter_index when the plan has no usable index
+        "plan_index": chapter_index if plan_index is None else plan_index,
+        "position": _as_str(plan_data.get("position")),
+        "dramatic_goal": _as_str(plan_data.get("dramatic_goal")),
+    }
 
 #================================================================#
 #                       Project CRUD                             #
 #================================================================#
 
+@tracing.traced(category="db")
 def get_project(db: Session, project_id: int):
     return db.query(models.Project).filter(models.Project.id == project_id).first()
 
+@tracing.traced(category="db")
 def get_projects(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Project).offset(skip).limit(limit).all()
 
+@tracing.traced(category="db")
+def get_project_rows(db: Session, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+    projects = [
+        {"id": row.id, "name": row.name, "description": row.description, "characters": []}
+        for row in db.query(models.Project.id, models.Project.name, models.Project.description)
+        .offset(skip).limit(limit).all()
+    ]
+    by_id = {project["id"]: project for project in projects}
+    if by_id:
+        # One query for all characters instead of one lazy load per project
+        character_rows = db.query(models.Character.id, models.Character.project_id, models.Character.data) \
+            .filter(models.Character.project_id.in_(list(by_id))).all()
+        for row in character_rows:
+            by_id[row.project_id]["characters"].append(row._asdict())
+    return projects
+
+@tracing.traced(category="db")
 def create_project(db: Session, project: schemas.ProjectCreate):
     db_project = models.Project(name=project.name, description=project.description)
     db.add(db_project)
-    db.commit()
+    with tracing.span("db.commit", category="db"):
+        db.commit()
     db.refresh(db_project)
     return db_project
 
@@ -22,30 +90,61 @@ def create_project(db: Session, project: schemas.ProjectCreate):
 #                       Character CRUD                           #
 #================================================================#
 
+@tracing.traced(category="db")
 def create_project_character(db: Session, character: schemas.CharacterCreate, project_id: int):
-    db_character = models.Character(**character.dict(), project_id=project_id)
+    db_character = models.Character(**character.dict(), **_character_columns(character.data), project_id=project_id)
     db.add(db_character)
-    db.commit()
+    with tracing.span("db.commit", category="db"):
+        db.commit()
     db.refresh(db_character)
     return db_character
 
+@tracing.traced(category="db")
 def get_characters_by_project(db: Session, project_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.Character).filter(models.Character.project_id == project_id).offset(skip).limit(limit).all()
 
+@tracing.traced(category="db")
 def get_all_characters(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.Character).offset(skip).limit(limit).all()
 
+@tracing.traced(category="db")
+def get_character_rows(
+    db: Session,
+    project_id: int = None,
+    skip: int = 0,
+    limit: int = 100,
+    name: Optional[str] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    social_class: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    query = db.query(models.Character.id, models.Character.project_id, models.Character.data)
+    if project_id is not None:
+        query = query.filter(models.Character.project_id == project_id)
+    if name is not None:
+        query = query.filter(models.Character.name == name)
+    if min_age is not None:
+        query = query.filter(models.Character.age >= min_age)
+    if max_age is not None:
+        query = query.filter(models.Character.age <= max_age)
+    if social_class is not None:
+        query = query.filter(models.Character.social_class == social_class)
+    return [row._asdict() for row in query.offset(skip).limit(limit).all()]
+
 #================================================================#
 #                       StoryOutline CRUD                        #
 #================================================================#
 
+@tracing.traced(category="db")
 def create_project_story_outline(db: Session, outline: schemas.StoryOutlineCreate, project_id: int):
     db_outline = models.StoryOutline(**outline.dict(), project_id=project_id)
     db.add(db_outline)
-    db.commit()
+    with tracing.span("db.commit", category="db"):
+        db.commit()
     db.refresh(db_outline)
     return db_outline
 
+@tracing.traced(category="db")
 def get_story_outline_by_project_id(db: Session, project_id: int):
     return db.query(models.StoryOutline).filter(models.StoryOutline.project_id == project_id).first()
 
@@ -53,24 +152,92 @@ def get_story_outline_by_project_id(db: Session, project_id: int):
 #                       Chapter CRUD                             #
 #================================================================#
 
+@tracing.traced(category="db")
 def create_project_chapter(db: Session, chapter: schemas.ChapterCreate, project_id: int):
-    db_chapter = models.Chapter(**chapter.dict(), project_id=project_id)
+    db_chapter = models.Chapter(
+        **chapter.dict(), **_chapter_columns(chapter.plan_data, chapter.chapter_index), project_id=project_id
+    )
     db.add(db_chapter)
-    db.commit()
+    with tracing.span("db.commit", category="db"):
+        db.commit()
     db.refresh(db_chapter)
     return db_chapter
 
+@tracing.traced(category="db")
 def get_chapters_by_project_id(db: Session, project_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.Chapter).filter(models.Chapter.project_id == project_id).offset(skip).limit(limit).all()
 
+@tracing.traced(category="db")
+def get_chapter_rows_by_project_id(
+    db: Session,
+    project_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    plan_index: Optional[int] = None,
+    position: Optional[str] = None,
+    dramatic_goal: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    query = db.query(
+        models.Chapter.id,
+        models.Chapter.project_id,
+        models.Chapter.chapter_index,
+        models.Chapter.plan_data,
+        models.Chapter.content,
+    ).filter(models.Chapter.project_id == project_id)
+    if plan_index is not None:
+        query = query.filter(models.Chapter.plan_index == plan_index)
+    if position is not None:
+        query = query.filter(models.Chapter.position == position)
+    if dramatic_goal is not None:
+        query = query.filter(models.Chapter.dramatic_goal == dramatic_goal)
+    rows = query.offset(skip).limit(limit).all()
+    return [row._asdict() for row in rows]
+
+@tracing.traced(category="db")
 def get_chapter(db: Session, chapter_id: int):
     return db.query(models.Chapter).filter(models.Chapter.id == chapter_id).first()
 
+@tracing.traced(category="db")
+def get_next_chapter(db: Session, project_id: int, chapter_index: int):
+    return db.query(models.Chapter).filter(
+        models.Chapter.project_id == project_id, models.Chapter.chapter_index > chapter_index
+    ).order_by(models.Chapter.chapter_index).first()
+
+@tracing.traced(category="db")
 def update_chapter_content(db: Session, chapter_id: int, content: str):
     db_chapter = get_chapter(db, chapter_id=chapter_id)
     if db_chapter:
         db_chapter.content = content
-        db.commit()
+        db_chapter.content_revision = models.Chapter.content_revision + 1
+        with tracing.span("db.commit", category="db"):
+            db.commit()
         db.refresh(db_chapter)
     return db_chapter
 
+
+#================================================================#
+#                       Usage CRUD                               #
+#================================================================#
+
+@tracing.traced(category="db")
+def get_project_usage(db: Session, project_id: int):
+    return db.query(models.ProjectUsage).filter(models.ProjectUsage.project_id == project_id).first()
+
+@tracing.traced(category="db")
+def add_project_usage(db: Session, deltas: Dict[int, Dict[str, int]]):
+    """Adds usage deltas for several projects in a single commit."""
+    now = datetime.utcnow()
+    existing = {
+        row.project_id: row
+        for row in db.query(models.ProjectUsage).filter(models.ProjectUsage.project_id.in_(list(deltas))).all()
+    }
+    for project_id, delta in deltas.items():
+        row = existing.get(project_id)
+        if row is None:
+            row = models.ProjectUsage(project_id=project_id, **{field: 0 for field in delta})
+            db.add(row)
+        for field, value in delta.items():
+            setattr(row, field, (getattr(row, field) or 0) + value)
+        row.updated_at = now
+    with tracing.span("db.commit", category="db"):
+        db.commit()
@@ -0,0 +1,254 @@
+import hashlib
+import random
+import threading
+import zlib
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import models
+
+# --------------------------------------------------------------------------
+# Near-duplicate detection for generated chapter text.
+#
+# Text is cut into windows of WINDOW_CHARS characters; each window is sketched
+# as a MinHash signature over its character n-grams (shingles). Saved chapters
+# are indexed with half-overlapping windows in an LSH table, so a window of new
+# text finds similar passages in prior chapters without a full scan.
+# Streaming checks update the current window's signature per shingle, which
+# keeps the cost per chunk proportional to the chunk length.
+# --------------------------------------------------------------------------
+
+SHINGLE_SIZE = 5
+WINDOW_CHARS = 200
+NUM_HASHES = 32
+BANDS = 8
+ROWS_PER_BAND = NUM_HASHES // BANDS
+
+# Repetition loops: share of recent shingles that already occurred in this stream
+LOOP_SHINGLES = 150
+LOOP_THRESHOLD = 0.6
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_HASHES)]
+
+
+def shingle_hash(shingle: str) -> int:
+    return zlib.crc32(shingle.encode("utf-8"))
+
+
+def permute(h: int) -> List[int]:
+    """The NUM_HASHES permuted values of one shingle hash."""
+    return [(a * h + b) % _PRIME for a, b in _PERMUTATIONS]
+
+
+def empty_signature() -> List[int]:
+    return [_PRIME] * NUM_HASHES
+
+
+def update_signature(signature: List[int], h: int) -> None:
+    """Folds one shingle hash into a MinHash signature in place."""
+    for i, (a, b) in enumerate(_PERMUTATIONS):
+        value = (a * h + b) % _PRIME
+        if value < signature[i]:
+            signature[i] = value
+
+
+def similarity(sig_a: Iterable[int], sig_b: Iterable[int]) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / NUM_HASHES
+
+
+def band_keys(signature: List[int]) -> List[Tuple[int, Tuple[int, ...]]]:
+    return [
+        (band, tuple(signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]))
+        for band in range(BANDS)
+    ]
+
+
+def sketch_windows(text: str) -> List[Tuple[int, List[int]]]:
+    """
+    Returns (offset, signature) for half-overlapping windows over `text`.
+    Each shingle is permuted once; window signatures are the element-wise
+    minimum of their two half-window blocks.
+    """
+    half = WINDOW_CHARS // 2
+    blocks = []
+    for start in range(0, max(len(text) - SHINGLE_SIZE + 1, 0), half):
+        block = empty_signature()
+        end = min(start + half, len(text) - SHINGLE_SIZE + 1)
+        for pos in range(start, end):
+            values = permute(shingle_hash(text[pos:pos + SHINGLE_SIZE]))
+            block = [v if v < m else m for v, m in zip(values, block)]
+        blocks.append((start, block))
+    if len(blocks) == 1:
+        return blocks
+    return [
+        (start, [min(x, y) for x, y in zip(block, next_block)])
+        for (start, block), (_, next_block) in zip(blocks, blocks[1:])
+    ]
+
+
+class ProjectIndex:
+    """
+    LSH index over the window signatures of a project's saved chapters.
+    Immutable once published: streams query it while a newer one is built.
+    """
+
+    def __init__(self, project_id: int, contents: Optional[Dict[int, str]] = None,
+                 previous: Optional["ProjectIndex"] = None, fingerprint: Optional[Tuple] = None):
+        """Sketches `contents` (chapter_id -> text), reusing unchanged chapters of `previous`."""
+        self.project_id = project_id
+        self.fingerprint = fingerprint
+        # chapter_id -> (content digest, [(offset, signature)])
+        self.chapters: Dict[int, Tuple[str, List[Tuple[int, List[int]]]]] = {}
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[Tuple[int, int]]] = {}
+        reusable = previous.chapters if previous is not None else {}
+        for chapter_id, content in (contents or {}).items():
+            digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+            cached = reusable.get(chapter_id)
+            self.chapters[chapter_id] = cached if cached and cached[0] == digest else (digest, sketch_windows(content))
+        for chapter_id, (_, windows) in self.chapters.items():
+            for window_no, (_, signature) in enumerate(windows):
+                for key in band_keys(signature):
+                    self.buckets.setdefault(key, []).append((chapter_id, window_no))
+
+    def _window(self, chapter_id: int, window_no: int) -> Tuple[int, List[int]]:
+        return self.chapters[chapter_id][1][window_no]
+
+    def query(self, signature: List[int], threshold: float, exclude_chapter_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Best matching window of another chapter at or above `threshold`, if any."""
+        best = None
+        seen = set()
+        for key in band_keys(signature):
+            for candidate in self.buckets.get(key, ()):
+                if candidate in seen or candidate[0] == exclude_chapter_id:
+                    continue
+                seen.add(candidate)
+                offset, other = self._window(*candidate)
+                score = similarity(signature, other)
+                if score >= threshold and (best is None or score > best["similarity"]):
+                    best = {"chapter_id": candidate[0], "offset": offset, "similarity": score}
+        return best
+
+    def report(self, threshold: float) -> List[Dict[str, Any]]:
+        """All pairs of similar windows, across chapters or non-overlapping within one."""
+        pairs = {}
+        for members in self.buckets.values():
+            if len(members) < 2:
+                continue
+            for i, first in enumerate(members):
+                for second in members[i + 1:]:
+                    pair = (first, second) if first < second else (second, first)
+                    if pair in pairs:
+                        continue
+                    (offset_a, sig_a), (offset_b, sig_b) = self._window(*pair[0]), self._window(*pair[1])
+                    if pair[0][0] == pair[1][0] and abs(offset_a - offset_b) < WINDOW_CHARS:
+                        continue
+                    score = similarity(sig_a, sig_b)
+                    if score >= threshold:
+                        pairs[pair] = {
+                            "chapter_id": pair[0][0],
+                            "offset": offset_a,
+                            "other_chapter_id": pair[1][0],
+                            "other_offset": offset_b,
+                            "similarity": score,
+                        }
+        return sorted(pairs.values(), key=lambda item: -item["similarity"])
+
+
+_indexes: Dict[int, ProjectIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_project_index(db: Session, project_id: int) -> ProjectIndex:
+    """
+    Returns the project's index, refreshed if its chapters changed.
+    Staleness is detected with a cheap aggregate query, so writes made by other
+    worker processes are picked up without explicit invalidation. Content edits
+    are counted in content_revision, which also catches edits of the same length.
+    """
+    fingerprint = tuple(db.query(
+        func.count(models.Chapter.id),
+        func.max(models.Chapter.id),
+        func.sum(models.Chapter.content_revision),
+    ).filter(models.Chapter.project_id == project_id).one())
+    with _indexes_lock:
+        index = _indexes.get(project_id)
+        if index is None or index.fingerprint != fingerprint:
+            rows = db.query(models.Chapter.id, models.Chapter.content).filter(
+                models.Chapter.project_id == project_id, models.Chapter.content.isnot(None)
+            ).all()
+            # A new index replaces the old one, which in-flight streams keep using
+            index = ProjectIndex(project_id, {row.id: row.content for row in rows}, index, fingerprint)
+            _indexes[project_id] = index
+        return index
+
+
+class StreamMonitor:
+    """
+    Incremental checks over one generation stream.
+    feed() returns a finding dict the first time a repetition loop or an
+    overlap with a prior chapter is detected in a window, otherwise None.
+    """
+
+    def __init__(self, index: Optional[ProjectIndex] = None, chapter_id: Optional[int] = None,
+                 overlap_threshold: float = 0.5, loop_threshold: float = LOOP_THRESHOLD):
+        self.index = index
+        self.chapter_id = chapter_id
+        self.overlap_threshold = overlap_threshold
+        self.loop_threshold = loop_threshold
+        self.position = 0
+        self._tail = ""
+        self._window_start = 0
+        self._signature = empty_signature()
+        self._seen = set()
+        self._recent = deque(maxlen=LOOP_SHINGLES)
+        self._repeats = 0
+        self._loop_reported = False
+
+    def feed(self, chunk: str) -> Optional[Dict[str, Any]]:
+        text = self._tail + chunk
+        finding = None
+        for pos in range(len(text) - SHINGLE_SIZE + 1):
+            h = shingle_hash(text[pos:pos + SHINGLE_SIZE])
+            update_signature(self._signature, h)
+
+            repeated = h in self._seen
+            self._seen.add(h)
+            if len(self._recent) == self._recent.maxlen:
+                self._repeats -= self._recent[0]
+            self._recent.append(repeated)
+            self._repeats += repeated
+
+            self.position += 1
+            if finding is None:
+                finding = self._check()
+        self._tail = text[-(SHINGLE_SIZE - 1):]
+        return finding
+
+    def _check(self) -> Optional[Dict[str, Any]]:
+        if (not self._loop_reported and len(self._recent) == self._recent.maxlen
+                and self._repeats / len(self._recent) >= self.loop_threshold):
+            self._loop_reported = True
+            return {"type": "repetition_loop", "offset": self.position, "ratio": round(self._repeats / len(self._recent), 3)}
+
+        if self.position - self._window_start < WINDOW_CHARS:
+            return None
+        signature, window_start = self._signature, self._window_start
+        self._signature = empty_signature()
+        self._window_start = self.position
+        if self.index is None:
+            return None
+        match = self.index.query(signature, self.overlap_threshold, exclude_chapter_id=self.chapter_id)
+        if match is None:
+            return None
+        return {
+            "type": "chapter_overlap",
+            "offset": window_start,
+            "chapter_id": match["chapter_id"],
+            "chapter_offset": match["offset"],
+            "similarity": match["similarity"],
+        }
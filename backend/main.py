@@ -1,20 +1,37 @@
-from fastapi import FastAPI, Depends, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
-from typing import List
-from starlette.responses import StreamingResponse
+from typing import List, Optional, Union
+from starlette.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware # Import CORSMiddleware
 
 
-import crud, models, schemas, services
-from database import SessionLocal, engine, get_db
+import crud, schemas, services, tracing, usage
+from config import settings
+from serialization import FastJSONResponse
+from database import get_db, init_db
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create all database tables once per worker at startup, not at import time
+    init_db()
+    tracing.install_thread_profiling()
+    usage_flusher = asyncio.create_task(usage.tracker.run())
+    yield
+    usage_flusher.cancel()
+    await asyncio.gather(usage_flusher, return_exceptions=True)
+    # Write whatever usage is still pending before the worker exits
+    usage.tracker.flush()
 
-# Create all database tables
-models.Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title="NovelAI Creator API",
     description="API for generating and managing novel content.",
     version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
 )
 
 # Add CORS middleware
@@ -33,67 +50,191 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
 
+# Outermost, so traces cover the whole request including the streamed body
+app.add_middleware(tracing.TracingMiddleware)
+
 #================================================================#
 #                       AI Generation Endpoints                  #
 #================================================================#
 
+def _client_id(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+def enforce_rate_limit(request: Request):
+    """Per-client rate limit for the generation endpoints, shared across workers."""
+    try:
+        services.check_client_rate_limit(_client_id(request))
+    except services.RateLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+async def _admit(http_request: Request, project_id: Optional[int]) -> usage.UsageLease:
+    """
+    Checks the project and enforces token and concurrency quotas before the
+    request reaches the provider queue. The checks query the database, so they
+    run in a thread.
+    """
+    try:
+        with tracing.span("queue.admit", category="queue"):
+            lease = await asyncio.to_thread(usage.admit, project_id, _client_id(http_request))
+    except usage.UnknownProject:
+        raise HTTPException(status_code=404, detail="Project not found")
+    except usage.ProjectRequired as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except usage.QuotaExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    lease.keep_alive()
+    return lease
+
+class _LeasedStreamingResponse(StreamingResponse):
+    """
+    Streaming response that releases its lease once the response is over, also
+    when the client disconnects before the body iterator is ever started.
+    """
+
+    def __init__(self, content, lease: usage.UsageLease, **kwargs):
+        super().__init__(content, **kwargs)
+        self.lease = lease
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.lease.release()
+
+def _event_stream(stream, lease: usage.UsageLease) -> StreamingResponse:
+    """SSE response that holds `lease` until the response ends."""
+    return _LeasedStreamingResponse(stream, lease, media_type="text/event-stream")
+
+async def _generate_candidates(prompt: str, response_model, request: schemas.CandidateOptions, lease: usage.UsageLease):
+    """
+    Dispatches a multi-candidate (`n > 1`) generation request.
+    Returns an SSE stream, the first valid candidate, or the list of valid candidates.
+    """
+    if request.stream:
+        return _event_stream(
+            services.stream_candidates(prompt, response_model, request.n, request.first_valid_wins, lease=lease),
+            lease,
+        )
+    try:
+        if request.first_valid_wins:
+            return await services.generate_first_valid_candidate(prompt, response_model, request.n, lease=lease)
+        return await services.generate_candidates(prompt, response_model, request.n, lease=lease)
+    finally:
+        await lease.release()
+
 @app.post("/character/generate", 
-          response_model=schemas.CharacterGenerateResponse,
+          dependencies=[Depends(enforce_rate_limit)],
+          response_model=Union[schemas.CharacterGenerateResponse, List[schemas.CharacterGenerateResponse]],
           tags=["AI Generation"],
           summary="Generate a new character from a prompt")
 async def generate_character(
     request: schemas.CharacterGenerateRequest,
+    http_request: Request,
 ):
     """
     Generates a detailed character profile based on a theme and a user prompt.
 
     This endpoint interfaces with an AI model to create a rich character description,
     which can then be saved and used in a story.
+
+    Set `n` to generate several candidates concurrently; see `CandidateOptions`.
     """
+    lease = await _admit(http_request, request.project_id)
+    if request.n > 1 or request.stream:
+        return await _generate_candidates(
+            services.build_character_prompt(request), schemas.CharacterGenerateResponse, request, lease
+        )
     # In a real implementation, you would add error handling here
     # and potentially select the AI provider (Ollama vs API)
-    return await services.generate_character_from_ai(request)
+    try:
+        return await services.generate_character_from_ai(request, lease=lease)
+    finally:
+        await lease.release()
 
 @app.post("/story/outline", 
-          response_model=schemas.StoryOutlineResponse,
+          dependencies=[Depends(enforce_rate_limit)],
+          response_model=Union[schemas.StoryOutlineResponse, List[schemas.StoryOutlineResponse]],
           tags=["AI Generation"],
           summary="Generate a story outline based on characters and theme")
 async def generate_story_outline(
     request: schemas.StoryOutlineRequest,
+    http_request: Request,
 ):
     """
     Generates a story outline, including theme, core conflict, character relationships,
     world setting, and plot structure, based on provided characters, theme, and style.
+
+    Set `n` to generate several candidates concurrently; see `CandidateOptions`.
     """
-    return await services.generate_story_outline_from_ai(request)
+    lease = await _admit(http_request, request.project_id)
+    if request.n > 1 or request.stream:
+        return await _generate_candidates(
+            services.build_story_outline_prompt(request), schemas.StoryOutlineResponse, request, lease
+        )
+    try:
+        return await services.generate_story_outline_from_ai(request, lease=lease)
+    finally:
+        await lease.release()
 
 @app.post("/story/chapters", 
-          response_model=schemas.ChapterPlanResponse,
+          dependencies=[Depends(enforce_rate_limit)],
+          response_model=Union[schemas.ChapterPlanResponse, List[schemas.ChapterPlanResponse]],
           tags=["AI Generation"],
           summary="Generate a chapter plan based on story outline and chapter count")
 async def generate_chapter_plan(
     request: schemas.ChapterPlanRequest,
+    http_request: Request,
 ):
     """
     Generates a detailed chapter plan, including position, dramatic goal,
     inner conflict display, and summary for each chapter.
+
+    Set `n` to generate several candidates concurrently; see `CandidateOptions`.
     """
-    return await services.generate_chapter_plan_from_ai(request)
+    lease = await _admit(http_request, request.project_id)
+    if request.n > 1 or request.stream:
+        return await _generate_candidates(
+            services.build_chapter_plan_prompt(request), schemas.ChapterPlanResponse, request, lease
+        )
+    try:
+        return await services.generate_chapter_plan_from_ai(request, lease=lease)
+    finally:
+        await lease.release()
 
 @app.post("/story/expand", 
+          dependencies=[Depends(enforce_rate_limit)],
           tags=["AI Generation"],
           summary="Expand a chapter summary into full text (Streaming)")
 async def expand_story_stream(
     request: schemas.StoryExpandRequest,
+    http_request: Request,
 ):
     """
     Expands a chapter summary into a full-length chapter text using a streaming response.
     
     This endpoint provides a real-time stream of generated text.
+    Pass `chapter_id` to use (and feed) speculative expansion of the next chapter.
+    """
+    if request.project_id is None and request.chapter_id is not None:
+        request.project_id = await asyncio.to_thread(services.project_id_for_chapter, request.chapter_id)
+        if request.project_id is None:
+            raise HTTPException(status_code=404, detail="Chapter not found")
+    lease = await _admit(http_request, request.project_id)
+    return _event_stream(services.stream_expand_from_ai(request, lease=lease), lease)
+
+
+@app.get("/speculation/stats",
+         tags=["AI Generation"],
+         summary="Speculative expansion hit rate and wasted generation time")
+def read_speculation_stats():
     """
-    return StreamingResponse(services.stream_expand_from_ai(request), media_type="text/event-stream")
+    Reports how often speculative next-chapter expansions were used and how much
+    generation time was spent on speculation that was discarded (this worker only).
+    """
+    return services.get_speculation_stats()
 
 
 #================================================================#
@@ -118,8 +259,8 @@ def read_projects(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
     """
     Retrieves a list of all projects.
     """
-    projects = crud.get_projects(db, skip=skip, limit=limit)
-    return projects
+    # Rows are already shaped like schemas.Project; serialize them directly
+    return FastJSONResponse(crud.get_project_rows(db, skip=skip, limit=limit))
 
 @app.get("/projects/{project_id}", 
          response_model=schemas.Project, 
@@ -157,17 +298,26 @@ def create_character_for_project(
          tags=["Characters"],
          summary="List characters in a project")
 def read_characters_for_project(
-    project_id: int, db: Session = Depends(get_db)
+    project_id: int,
+    name: Optional[str] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    social_class: Optional[str] = None,
+    db: Session = Depends(get_db),
 ):
     """
     Retrieves all characters associated with a specific project.
+    Optional filters on name, age range and social class run as indexed SQL.
     """
     # Verify project exists
     db_project = crud.get_project(db, project_id=project_id)
     if db_project is None:
         raise HTTPException(status_code=404, detail="Project not found")
         
-    return crud.get_characters_by_project(db=db, project_id=project_id)
+    return FastJSONResponse(crud.get_character_rows(
+        db=db, project_id=project_id,
+        name=name, min_age=min_age, max_age=max_age, social_class=social_class,
+    ))
 
 @app.post("/projects/{project_id}/story_outline/", 
           response_model=schemas.StoryOutline, 
@@ -232,16 +382,60 @@ def create_chapter_for_project(
          tags=["Chapters"],
          summary="List chapters in a project")
 def read_chapters_for_project(
-    project_id: int, db: Session = Depends(get_db)
+    project_id: int,
+    plan_index: Optional[int] = None,
+    position: Optional[str] = None,
+    dramatic_goal: Optional[str] = None,
+    db: Session = Depends(get_db),
 ):
     """
     Retrieves all chapters associated with a specific project.
+    Optional filters on plan index, position and dramatic goal run as indexed SQL.
     """
     db_project = crud.get_project(db, project_id=project_id)
     if db_project is None:
         raise HTTPException(status_code=404, detail="Project not found")
         
-    return crud.get_chapters_by_project_id(db=db, project_id=project_id)
+    return FastJSONResponse(crud.get_chapter_rows_by_project_id(
+        db=db, project_id=project_id,
+        plan_index=plan_index, position=position, dramatic_goal=dramatic_goal,
+    ))
+
+@app.get("/projects/{project_id}/duplicates", 
+         response_model=schemas.DuplicateReport, 
+         tags=["Chapters"],
+         summary="Report near-duplicate passages in a project")
+def read_duplicates_for_project(
+    project_id: int, threshold: Optional[float] = None, limit: int = 100, db: Session = Depends(get_db)
+):
+    """
+    Finds passages that repeat, verbatim or nearly, across the project's saved chapters
+    or within one chapter. Similarity is the estimated Jaccard similarity of the
+    passages' character n-grams (0-1).
+    """
+    db_project = crud.get_project(db, project_id=project_id)
+    if db_project is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+
+    if threshold is None:
+        threshold = settings.DEDUP_OVERLAP_THRESHOLD
+    passages = services.get_duplicate_report(db, project_id=project_id, threshold=threshold)
+    return {"project_id": project_id, "threshold": threshold, "passages": passages[:limit]}
+
+@app.get("/projects/{project_id}/usage", 
+         response_model=schemas.ProjectUsage, 
+         tags=["Projects"],
+         summary="Get token usage for a project")
+def read_project_usage(project_id: int, db: Session = Depends(get_db)):
+    """
+    Returns the project's accumulated generation usage: request count, prompt and
+    completion tokens, and the provider-reported durations (nanoseconds).
+    Includes usage not yet flushed to the database by this worker.
+    """
+    db_project = crud.get_project(db, project_id=project_id)
+    if db_project is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return {"project_id": project_id, **usage.get_project_usage(db, project_id=project_id)}
 
 @app.put("/chapters/{chapter_id}", 
          response_model=schemas.Chapter, 
@@ -264,12 +458,74 @@ def update_chapter_content(
          response_model=List[schemas.Character], 
          tags=["Characters"],
          summary="List all characters")
-def read_all_characters(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_all_characters(
+    skip: int = 0,
+    limit: int = 100,
+    name: Optional[str] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    social_class: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
     """
     Retrieves a list of all characters across all projects.
+    Accepts the same filters as the per-project listing.
+    """
+    return FastJSONResponse(crud.get_character_rows(
+        db, skip=skip, limit=limit,
+        name=name, min_age=min_age, max_age=max_age, social_class=social_class,
+    ))
+
+#================================================================#
+#                       Debug Endpoints                          #
+#================================================================#
+
+def require_debug_endpoints():
+    """The debug endpoints do not exist unless DEBUG_ENDPOINTS_ENABLED is set."""
+    if not settings.DEBUG_ENDPOINTS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.get("/debug/traces",
+         dependencies=[Depends(require_debug_endpoints)],
+         tags=["Debug"],
+         summary="List recent request traces")
+def read_traces():
+    """
+    Lists the traces recently recorded by this worker, newest first.
+    Requests are traced when TRACING_ENABLED is set and they send `X-Trace: 1`
+    or are sampled by TRACE_SAMPLE_RATE; the id is returned in `X-Trace-Id`.
+    """
+    return tracing.recent_traces()
+
+@app.get("/debug/traces/{trace_id}",
+         dependencies=[Depends(require_debug_endpoints)],
+         tags=["Debug"],
+         summary="Get a trace in Chrome trace event format")
+def read_trace(trace_id: str):
+    """
+    Returns the trace's spans as Chrome trace event JSON; save it and open it
+    in chrome://tracing or ui.perfetto.dev.
+    """
+    trace = tracing.get_trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return {"traceEvents": trace.events, "displayTimeUnit": "ms"}
+
+@app.get("/debug/traces/{trace_id}/profile",
+         dependencies=[Depends(require_debug_endpoints)],
+         response_class=PlainTextResponse,
+         tags=["Debug"],
+         summary="Get the profile captured for a trace")
+def read_trace_profile(trace_id: str):
+    """
+    Returns the cProfile or pyinstrument report captured while the traced request
+    ran (TRACE_PROFILER). Only one request is profiled at a time. cProfile reports
+    include the request's work in worker threads; pyinstrument covers the event loop only.
     """
-    characters = crud.get_all_characters(db, skip=skip, limit=limit)
-    return characters
+    trace = tracing.get_trace(trace_id)
+    if trace is None or trace.profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(trace.profile)
 
 # Placeholder for root path
 @app.get("/")
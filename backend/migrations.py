@@ -0,0 +1,130 @@
+"""
+Schema evolution for existing databases.
+
+`Base.metadata.create_all` only creates missing tables, so columns added to
+existing tables are applied here. The schema version is tracked in SQLite's
+`PRAGMA user_version`. Every step is idempotent (it checks before altering),
+because several workers may run the migrations at the same time.
+"""
+from typing import Callable, List, Tuple
+
+from sqlalchemy.engine import Connection, Engine
+
+
+def _columns(conn: Connection, table: str) -> set:
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl_type: str) -> None:
+    if column not in _columns(conn, table):
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+
+
+def _json_int(column: str, path: str) -> str:
+    """
+    SQL for the integer at `path` in a JSON column, or NULL if it is not a clean
+    integer. Matches crud._as_int: integers, integral reals and digit-only strings.
+    """
+    value = f"json_extract({column}, '{path}')"
+    return (
+        f"CASE json_type({column}, '{path}') "
+        f"WHEN 'integer' THEN {value} "
+        f"WHEN 'real' THEN CASE WHEN {value} = CAST({value} AS INTEGER) THEN CAST({value} AS INTEGER) END "
+        f"WHEN 'text' THEN CASE WHEN {value} <> '' AND {value} NOT GLOB '*[^0-9]*' THEN CAST({value} AS INTEGER) END "
+        f"END"
+    )
+
+
+def _json_text(column: str, path: str) -> str:
+    """SQL for the string at `path` in a JSON column, or NULL for any other type. Matches crud._as_str."""
+    return f"CASE json_type({column}, '{path}') WHEN 'text' THEN json_extract({column}, '{path}') END"
+
+
+def _backfill_promoted_strs(conn: Connection) -> None:
+    conn.exec_driver_sql(
+        "UPDATE chapters SET "
+        f"position = {_json_text('plan_data', '$.position')}, "
+        f"dramatic_goal = {_json_text('plan_data', '$.dramatic_goal')}"
+    )
+    conn.exec_driver_sql(
+        "UPDATE characters SET "
+        f"name = {_json_text('data', '$.name')}, "
+        f"social_class = {_json_text('data', '$.social_class')}"
+    )
+
+
+def _backfill_promoted_ints(conn: Connection) -> None:
+    conn.exec_driver_sql(
+        f"UPDATE chapters SET plan_index = COALESCE({_json_int('plan_data', '$.index')}, chapter_index)"
+    )
+    conn.exec_driver_sql(f"UPDATE characters SET age = {_json_int('data', '$.age')}")
+
+
+def _promote_query_fields(conn: Connection) -> None:
+    """Promotes plan and character fields out of the JSON payloads into indexed columns."""
+    _add_column(conn, "chapters", "plan_index", "INTEGER")
+    _add_column(conn, "chapters", "position", "VARCHAR")
+    _add_column(conn, "chapters", "dramatic_goal", "VARCHAR")
+    _add_column(conn, "characters", "name", "VARCHAR")
+    _add_column(conn, "characters", "age", "INTEGER")
+    _add_column(conn, "characters", "social_class", "VARCHAR")
+
+    # Same index names as the ones create_all derives from the models
+    for table, column in (
+        ("chapters", "project_id"),
+        ("chapters", "plan_index"),
+        ("chapters", "position"),
+        ("chapters", "dramatic_goal"),
+        ("characters", "project_id"),
+        ("characters", "name"),
+        ("characters", "age"),
+        ("characters", "social_class"),
+    ):
+        conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})")
+
+    # Backfill existing rows; the JSON payload stays the source of truth
+    _backfill_promoted_strs(conn)
+    _backfill_promoted_ints(conn)
+
+
+def _recoerce_promoted_ints(conn: Connection) -> None:
+    """
+    Version 1 backfilled with CAST, which turned "25岁" into 25 and "二十" into 0;
+    recompute the integer columns with the same rule as new rows.
+    """
+    _backfill_promoted_ints(conn)
+
+
+def _add_content_revision(conn: Connection) -> None:
+    """Adds the counter the dedup index uses to notice chapter edits."""
+    _add_column(conn, "chapters", "content_revision", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _recoerce_promoted_strs(conn: Connection) -> None:
+    """
+    Version 1 copied any JSON value into the string columns (objects and lists as
+    JSON text); keep only strings, like new rows.
+    """
+    _backfill_promoted_strs(conn)
+
+
+# (version, migration) in ascending order
+MIGRATIONS: List[Tuple[int, Callable[[Connection], None]]] = [
+    (1, _promote_query_fields),
+    (2, _recoerce_promoted_ints),
+    (3, _add_content_revision),
+    (4, _recoerce_promoted_strs),
+]
+
+
+def run_migrations(engine: Engine) -> None:
+    """Applies pending migrations. Only SQLite databases are migrated in place."""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for target, migration in MIGRATIONS:
+            if version < target:
+                migration(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {target}")
+                version = target
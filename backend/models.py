@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, JSON
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text, ForeignKey, JSON
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -18,11 +18,16 @@ class Character(Base):
     __tablename__ = "characters"
 
     id = Column(Integer, primary_key=True, index=True)
-    project_id = Column(Integer, ForeignKey("projects.id"))
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
     
     # The generated character data
     data = Column(JSON)
 
+    # Frequently queried fields promoted from `data` (kept in sync by crud)
+    name = Column(String, index=True, nullable=True)
+    age = Column(Integer, index=True, nullable=True)
+    social_class = Column(String, index=True, nullable=True)
+
     project = relationship("Project", back_populates="characters")
 
 
@@ -42,13 +47,35 @@ class Chapter(Base):
     __tablename__ = "chapters"
 
     id = Column(Integer, primary_key=True, index=True)
-    project_id = Column(Integer, ForeignKey("projects.id"))
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
     chapter_index = Column(Integer)
 
     # The generated chapter plan data
     plan_data = Column(JSON)
+
+    # Frequently queried fields promoted from `plan_data` (kept in sync by crud)
+    plan_index = Column(Integer, index=True, nullable=True)
+    position = Column(String, index=True, nullable=True)
+    dramatic_goal = Column(String, index=True, nullable=True)
     
     # The expanded chapter text
     content = Column(Text, nullable=True)
+    # Bumped on every content write, so caches can detect edits that keep the length
+    content_revision = Column(Integer, nullable=False, default=0, server_default="0")
 
     project = relationship("Project", back_populates="chapters")
+
+
+class ProjectUsage(Base):
+    __tablename__ = "project_usage"
+
+    project_id = Column(Integer, ForeignKey("projects.id"), primary_key=True)
+
+    # Aggregated from the counts Ollama reports per generation
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    total_duration_ns = Column(BigInteger, nullable=False, default=0)
+    prompt_eval_duration_ns = Column(BigInteger, nullable=False, default=0)
+    eval_duration_ns = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True)
@@ -1,28 +1,45 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional, Any, Dict
 
 #================================================================#
 #                       API Request Schemas                      #
 #================================================================#
 
-class CharacterGenerateRequest(BaseModel):
+class CandidateOptions(BaseModel):
+    # Number of candidates generated concurrently; 1 keeps the single-result behaviour
+    n: int = Field(1, ge=1, le=8)
+    # Return the first candidate that validates and cancel the rest
+    first_valid_wins: bool = False
+    # Stream each candidate over SSE as soon as it completes
+    stream: bool = False
+
+class CharacterGenerateRequest(CandidateOptions):
     theme: str
     prompt_question: str
     options: Optional[dict] = None
+    # Project the generation is accounted to (usage and quotas); must exist, and
+    # is required while PROJECT_TOKEN_QUOTA or PROJECT_CONCURRENCY_LIMIT is set
+    project_id: Optional[int] = None
 
-class StoryOutlineRequest(BaseModel):
+class StoryOutlineRequest(CandidateOptions):
     theme: str
     style: str
     characters: List[Dict[str, Any]]
+    project_id: Optional[int] = None
 
-class ChapterPlanRequest(BaseModel):
+class ChapterPlanRequest(CandidateOptions):
     outline: Dict[str, Any]
     chapter_count: int
+    project_id: Optional[int] = None
 
 class StoryExpandRequest(BaseModel):
     chapter_summary: str
     characters: List[Dict[str, Any]]
     style: str
+    # Saved chapter being expanded; enables speculative expansion of the next one
+    chapter_id: Optional[int] = None
+    # Defaults to the chapter's project when chapter_id is given
+    project_id: Optional[int] = None
 
 #================================================================#
 #                       Database Schemas (CRUD)                  #
@@ -118,6 +135,27 @@ class ChapterPlanResponse(BaseModel):
 class StoryExpandResponse(BaseModel):
     chapter_text: str
 
+class DuplicatePassage(BaseModel):
+    chapter_id: int
+    offset: int
+    other_chapter_id: int
+    other_offset: int
+    similarity: float
+
+class DuplicateReport(BaseModel):
+    project_id: int
+    threshold: float
+    passages: List[DuplicatePassage]
+
+class ProjectUsage(BaseModel):
+    project_id: int
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    total_duration_ns: int
+    prompt_eval_duration_ns: int
+    eval_duration_ns: int
+
 # Unified Error Schema from the docs
 class ErrorDetail(BaseModel):
     code: str
@@ -1,10 +1,20 @@
 import json
+import time
+import random
 import asyncio
+import hashlib
 import httpx
-from typing import Dict, Any, List, AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, AsyncGenerator, Callable, Optional, Type
 
-import schemas
+from pydantic import BaseModel
+
+import cassette, crud, database, dedup, schemas, tracing, usage
 from config import settings
+from speculation import SpeculationManager, SpeculativeEntry
+import shared_state
+from shared_state import get_state_backend
+from serialization import SSE_DONE, sse_chunk, sse_frame
 
 # --------------------------------------------------------------------------
 # 1. PROMPT TEMPLATES
@@ -123,39 +133,77 @@ PLOT_EXPANSION_PROMPT = """
 
 # (Other prompts will be added here later)
 
+# Sampling spread used when fanning out several candidates for the same prompt.
+# Each candidate gets its own seed and a slightly different temperature.
+# Seeds are drawn per request, so asking again yields new candidates.
+CANDIDATE_SEED_RANGE = 2 ** 31 - 1
+CANDIDATE_BASE_TEMPERATURE = 0.7
+CANDIDATE_TEMPERATURE_STEP = 0.1
+CANDIDATE_MAX_TEMPERATURE = 1.2
+
 # --------------------------------------------------------------------------
 # 2. AI CLIENT ABSTRACTION
 # --------------------------------------------------------------------------
 
+# Token counts and timings (ns) Ollama reports on the final response
+OLLAMA_USAGE_FIELDS = (
+    "prompt_eval_count",
+    "eval_count",
+    "total_duration",
+    "load_duration",
+    "prompt_eval_duration",
+    "eval_duration",
+)
+
+def parse_ollama_usage(data: Dict[str, Any]) -> Dict[str, int]:
+    return {field: int(data.get(field) or 0) for field in OLLAMA_USAGE_FIELDS}
+
+UsageCallback = Callable[[Dict[str, int]], None]
+
 class OllamaClient:
     """Client for interacting with the Ollama API."""
-    def __init__(self, base_url: str, model: str):
+    def __init__(self, base_url: str, model: str, transport: Optional[httpx.AsyncBaseTransport] = None):
         self.base_url = base_url
         self.model = model
         self.api_url = f"{self.base_url}/api/generate"
-
-    async def generate_json(self, prompt: str) -> Dict[str, Any]:
+        # Custom httpx transport, e.g. cassette record/replay; None uses the network
+        self.transport = transport
+
+    def build_payload(self, prompt: str, stream: bool, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        payload = {
+            "model": self.model,
+            "prompt": prompt,
+        }
+        if not stream:
+            payload["format"] = "json"
+        payload["stream"] = stream
+        if options:
+            payload["options"] = options
+        return payload
+
+    async def generate_json(self, prompt: str, options: Optional[Dict[str, Any]] = None,
+                            on_usage: Optional[UsageCallback] = None) -> Dict[str, Any]:
         """
         Generate a JSON response from Ollama.
         Includes retry logic and response cleaning.
+        `options` is forwarded as Ollama model options (e.g. seed, temperature).
+        `on_usage` receives the token counts of every attempt.
         """
+        payload = self.build_payload(prompt, stream=False, options=options)
+
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    response = await client.post(
-                        self.api_url,
-                        json={
-                            "model": self.model,
-                            "prompt": prompt,
-                            "format": "json",
-                            "stream": False,
-                        },
-                    )
+                async with httpx.AsyncClient(timeout=60.0, transport=self.transport) as client:
+                    # Non-streaming: prefill and generation both happen before the headers arrive
+                    with tracing.span("ollama.generate", category="ai", attempt=attempt + 1):
+                        response = await client.post(self.api_url, json=payload, extensions=tracing.request_extensions())
                     response.raise_for_status()
                     
                     response_data = response.json()
                     print(f"DEBUG: Full response from Ollama: {response_data}")
+                    if on_usage:
+                        on_usage(parse_ollama_usage(response_data))
 
                     json_string = response_data.get("response", "").strip()
                     
@@ -179,33 +227,51 @@ class OllamaClient:
                 if attempt == max_retries - 1:
                     raise Exception(f"Failed to decode JSON from Ollama after {max_retries} attempts.")
             
+            if options and "seed" in options:
+                # The same seed would sample the same invalid output again
+                payload["options"] = {**options, "seed": random.randrange(1, CANDIDATE_SEED_RANGE)}
             await asyncio.sleep(1)
         
         raise Exception("Ollama client failed to get a valid JSON response.")
 
-    async def stream_generate(self, prompt: str) -> AsyncGenerator[str, None]:
+    async def stream_generate(self, prompt: str, on_usage: Optional[UsageCallback] = None) -> AsyncGenerator[str, None]:
         """
         Generate a stream of text from Ollama.
+        `on_usage` receives the token counts from the final chunk.
         """
+        trace = tracing.current()
         try:
-            async with httpx.AsyncClient(timeout=300.0) as client:
+            async with httpx.AsyncClient(timeout=300.0, transport=self.transport) as client:
+                request_start = time.perf_counter()
                 async with client.stream(
                     "POST",
                     self.api_url,
-                    json={
-                        "model": self.model,
-                        "prompt": prompt,
-                        "stream": True,
-                    },
+                    json=self.build_payload(prompt, stream=True),
+                    extensions=tracing.request_extensions(),
                 ) as response:
+                    # Stages for tracing: connect + headers, prefill until the first token, generation
+                    headers_at = first_token_at = time.perf_counter()
+                    tokens = 0
+                    if trace:
+                        trace.add("ollama.headers", request_start, headers_at, "ai")
                     response.raise_for_status()
                     async for line in response.aiter_lines():
                         if line:
                             try:
                                 chunk = json.loads(line)
                                 if "response" in chunk:
+                                    if tokens == 0:
+                                        first_token_at = time.perf_counter()
+                                        if trace:
+                                            trace.add("ollama.prefill", headers_at, first_token_at, "ai")
+                                    tokens += 1
                                     yield chunk["response"]
                                 if chunk.get("done"):
+                                    if on_usage:
+                                        on_usage(parse_ollama_usage(chunk))
+                                    if trace:
+                                        trace.add("ollama.generation", first_token_at, time.perf_counter(), "ai",
+                                                  chunks=tokens, **parse_ollama_usage(chunk))
                                     break
                             except json.JSONDecodeError:
                                 print(f"Warning: Could not decode stream line from Ollama: {line}")
@@ -214,88 +280,461 @@ class OllamaClient:
             yield f"Error: Could not connect to Ollama. Details: {e}"
 
 
-# TODO: Implement OpenAIClient and a factory to switch between them based on config
-if settings.AI_PROVIDER == 'ollama':
-    ai_client = OllamaClient(base_url=settings.OLLAMA_API_BASE_URL, model=settings.OLLAMA_MODEL_NAME)
-else:
-    ai_client = None
-    print(f"AI_PROVIDER '{settings.AI_PROVIDER}' is not yet supported. Using mock data.")
+# Provider registry: AI_PROVIDER name -> factory building the client.
+# TODO: Implement OpenAIClient and register it here
+AI_PROVIDERS: Dict[str, Callable[[], Any]] = {
+    "ollama": lambda: OllamaClient(
+        base_url=settings.OLLAMA_API_BASE_URL,
+        model=settings.OLLAMA_MODEL_NAME,
+        transport=cassette.transport_from_settings(settings),
+    ),
+}
+
+_ai_client = None
+_ai_client_initialized = False
+
+def get_ai_client():
+    """
+    Returns the configured AI client, building it on first use.
+    Returns None when the configured provider is not supported.
+    """
+    global _ai_client, _ai_client_initialized
+    if not _ai_client_initialized:
+        factory = AI_PROVIDERS.get(settings.AI_PROVIDER)
+        if factory is None:
+            print(f"AI_PROVIDER '{settings.AI_PROVIDER}' is not yet supported. Using mock data.")
+            _ai_client = None
+        else:
+            _ai_client = factory()
+        _ai_client_initialized = True
+    return _ai_client
+
+
+# --------------------------------------------------------------------------
+# 3. SHARED LIMITS AND CACHE
+# --------------------------------------------------------------------------
+
+UPSTREAM_SLOT_NAME = "upstream"
+
+speculation = SpeculationManager(max_entries=settings.SPECULATIVE_MAX_ENTRIES)
+
+class RateLimitExceeded(Exception):
+    """Raised when a client exceeds CLIENT_RATE_LIMIT_PER_MINUTE."""
+
+def check_client_rate_limit(client_id: str) -> None:
+    """Counts one generation request for `client_id`; raises RateLimitExceeded past the limit."""
+    limit = settings.CLIENT_RATE_LIMIT_PER_MINUTE
+    if limit <= 0:
+        return
+    count = get_state_backend().incr_window(f"rate:{client_id}", 1, 60)
+    if count > limit:
+        raise RateLimitExceeded(f"Rate limit of {limit} generation requests per minute exceeded.")
+
+@asynccontextmanager
+async def upstream_slot(foreground: bool = True):
+    """
+    Holds one of the UPSTREAM_CONCURRENCY_LIMIT slots for a call to the AI provider.
+    The limit is global across workers when the shared state backend is. The
+    slot's lease is renewed for as long as the call runs.
+    A foreground request that has to wait preempts this worker's running speculation.
+    """
+    state = get_state_backend()
+    lease_seconds = settings.UPSTREAM_SLOT_LEASE_SECONDS
+    deadline = time.monotonic() + settings.UPSTREAM_QUEUE_TIMEOUT_SECONDS
+    delay = 0.01
+    with tracing.span("queue.upstream_slot", category="queue"):
+        while True:
+            token = await shared_state.call(state.try_acquire, UPSTREAM_SLOT_NAME, settings.UPSTREAM_CONCURRENCY_LIMIT, lease_seconds)
+            if token is not None:
+                break
+            if foreground and speculation.preempt():
+                delay = 0.01
+            if time.monotonic() >= deadline:
+                raise Exception("Timed out waiting for a free AI provider slot.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+    heartbeat = shared_state.start_heartbeat(UPSTREAM_SLOT_NAME, token, lease_seconds)
+    try:
+        yield
+    finally:
+        heartbeat.cancel()
+        await shared_state.call(state.release, UPSTREAM_SLOT_NAME, token)
+
+def _response_cache_key(prompt: str, options: Optional[Dict[str, Any]]) -> str:
+    payload = json.dumps([settings.AI_PROVIDER, settings.OLLAMA_MODEL_NAME, prompt, options], ensure_ascii=False, sort_keys=True)
+    return "response:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _usage_callback(lease: Optional[usage.UsageLease]) -> Optional[UsageCallback]:
+    return lease.record if lease is not None else None
+
+async def _generate_json(ai_client, prompt: str, response_model: Type[BaseModel],
+                         options: Optional[Dict[str, Any]] = None,
+                         lease: Optional[usage.UsageLease] = None) -> BaseModel:
+    """
+    Calls `ai_client.generate_json` through the shared response cache and upstream limit
+    and validates the answer against `response_model`. Only valid answers are cached.
+    Token usage is attributed to `lease` when given.
+    """
+    ttl = settings.RESPONSE_CACHE_TTL_SECONDS
+    state = get_state_backend()
+    cache_key = _response_cache_key(prompt, options)
+    if ttl > 0:
+        cached = await shared_state.call(state.cache_get, cache_key)
+        if cached is not None:
+            return response_model(**cached)
+
+    speculation.foreground_started()
+    try:
+        async with upstream_slot():
+            response_json = await ai_client.generate_json(prompt, options=options, on_usage=_usage_callback(lease))
+    finally:
+        speculation.foreground_finished()
+
+    result = response_model(**response_json)
+    if ttl > 0:
+        await shared_state.call(state.cache_set, cache_key, response_json, ttl)
+    return result
 
 
 # --------------------------------------------------------------------------
-# 3. SERVICE FUNCTIONS
+# 4. SERVICE FUNCTIONS
 # --------------------------------------------------------------------------
 
-async def generate_character_from_ai(request: schemas.CharacterGenerateRequest) -> schemas.CharacterGenerateResponse:
+@tracing.traced("prompt.render")
+def build_character_prompt(request: schemas.CharacterGenerateRequest) -> str:
+    return CHARACTER_GEN_PROMPT.format(prompt_question=request.prompt_question, theme=request.theme)
+
+@tracing.traced("prompt.render")
+def build_story_outline_prompt(request: schemas.StoryOutlineRequest) -> str:
+    characters_json_str = json.dumps(request.characters, ensure_ascii=False, indent=2)
+    return STORY_OUTLINE_PROMPT.format(characters_json=characters_json_str, theme=request.theme, style=request.style)
+
+@tracing.traced("prompt.render")
+def build_chapter_plan_prompt(request: schemas.ChapterPlanRequest) -> str:
+    outline_json_str = json.dumps(request.outline, ensure_ascii=False, indent=2)
+    return CHAPTER_PLAN_PROMPT.format(outline_json=outline_json_str, chapter_count=request.chapter_count)
+
+async def generate_character_from_ai(request: schemas.CharacterGenerateRequest, lease: Optional[usage.UsageLease] = None) -> schemas.CharacterGenerateResponse:
     """Generates a character by calling the configured AI model."""
+    ai_client = get_ai_client()
     if not ai_client:
         print("Warning: AI client not supported. Falling back to mock data.")
         # ... (mock data logic remains)
-    prompt = CHARACTER_GEN_PROMPT.format(prompt_question=request.prompt_question, theme=request.theme)
+    prompt = build_character_prompt(request)
     try:
-        response_json = await ai_client.generate_json(prompt)
-        return schemas.CharacterGenerateResponse(**response_json)
+        return await _generate_json(ai_client, prompt, schemas.CharacterGenerateResponse, lease=lease)
     except Exception as e:
         print(f"An exception occurred in generate_character_from_ai: {e}")
         raise
 
-async def generate_story_outline_from_ai(request: schemas.StoryOutlineRequest) -> schemas.StoryOutlineResponse:
+async def generate_story_outline_from_ai(request: schemas.StoryOutlineRequest, lease: Optional[usage.UsageLease] = None) -> schemas.StoryOutlineResponse:
     """Generates a story outline by calling the configured AI model."""
+    ai_client = get_ai_client()
     if not ai_client:
         print("Warning: AI client not supported. Falling back to mock data.")
         # ... (mock data logic remains)
-    characters_json_str = json.dumps(request.characters, ensure_ascii=False, indent=2)
-    prompt = STORY_OUTLINE_PROMPT.format(characters_json=characters_json_str, theme=request.theme, style=request.style)
+    prompt = build_story_outline_prompt(request)
     try:
-        response_json = await ai_client.generate_json(prompt)
-        return schemas.StoryOutlineResponse(**response_json)
+        return await _generate_json(ai_client, prompt, schemas.StoryOutlineResponse, lease=lease)
     except Exception as e:
         print(f"An exception occurred in generate_story_outline_from_ai: {e}")
         raise
 
-async def generate_chapter_plan_from_ai(request: schemas.ChapterPlanRequest) -> schemas.ChapterPlanResponse:
+async def generate_chapter_plan_from_ai(request: schemas.ChapterPlanRequest, lease: Optional[usage.UsageLease] = None) -> schemas.ChapterPlanResponse:
     """Generates a chapter plan by calling the configured AI model."""
+    ai_client = get_ai_client()
     if not ai_client:
         print("Warning: AI client not supported. Falling back to mock data.")
         # ... (mock data logic remains)
-    outline_json_str = json.dumps(request.outline, ensure_ascii=False, indent=2)
-    prompt = CHAPTER_PLAN_PROMPT.format(outline_json=outline_json_str, chapter_count=request.chapter_count)
+    prompt = build_chapter_plan_prompt(request)
     try:
-        response_json = await ai_client.generate_json(prompt)
-        return schemas.ChapterPlanResponse(**response_json)
+        return await _generate_json(ai_client, prompt, schemas.ChapterPlanResponse, lease=lease)
     except Exception as e:
         print(f"An exception occurred in generate_chapter_plan_from_ai: {e}")
         raise
 
-async def stream_expand_from_ai(request: schemas.StoryExpandRequest) -> AsyncGenerator[str, None]:
+# --------------------------------------------------------------------------
+# 5. MULTI-CANDIDATE GENERATION
+# --------------------------------------------------------------------------
+
+def candidate_options(index: int, base_seed: int) -> Dict[str, Any]:
+    """Sampling options for the candidate at `index` of a request drawn with `base_seed`."""
+    temperature = min(CANDIDATE_BASE_TEMPERATURE + index * CANDIDATE_TEMPERATURE_STEP, CANDIDATE_MAX_TEMPERATURE)
+    return {"seed": base_seed + index, "temperature": round(temperature, 2)}
+
+async def _generate_candidate(prompt: str, response_model: Type[BaseModel], options: Dict[str, Any],
+                              lease: Optional[usage.UsageLease]) -> BaseModel:
+    return await _generate_json(get_ai_client(), prompt, response_model, options=options, lease=lease)
+
+async def iter_candidates(prompt: str, response_model: Type[BaseModel], n: int,
+                          lease: Optional[usage.UsageLease] = None) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Runs `n` candidate generations concurrently and yields each one as it completes.
+
+    Every yielded item is `{"index": i, "seed": s, "candidate": model}` for a candidate
+    that validated against `response_model`, or `{"index": i, "seed": s, "error": str}`
+    otherwise. Candidates still running when the consumer stops iterating are cancelled.
+    """
+    if not get_ai_client():
+        raise Exception(f"AI_PROVIDER '{settings.AI_PROVIDER}' does not support candidate generation.")
+
+    base_seed = random.randrange(1, CANDIDATE_SEED_RANGE - n)
+    options = [candidate_options(i, base_seed) for i in range(n)]
+    tasks = {
+        asyncio.create_task(_generate_candidate(prompt, response_model, options[i], lease)): i
+        for i in range(n)
+    }
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = tasks[task]
+                seed = options[index]["seed"]
+                try:
+                    yield {"index": index, "seed": seed, "candidate": task.result()}
+                except Exception as e:
+                    print(f"Candidate {index} failed: {e}")
+                    yield {"index": index, "seed": seed, "error": str(e)}
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def generate_candidates(prompt: str, response_model: Type[BaseModel], n: int,
+                              lease: Optional[usage.UsageLease] = None) -> List[BaseModel]:
+    """Generates `n` candidates concurrently and returns the valid ones in completion order."""
+    candidates = []
+    async for result in iter_candidates(prompt, response_model, n, lease):
+        if "candidate" in result:
+            candidates.append(result["candidate"])
+    if not candidates:
+        raise Exception(f"All {n} candidate generations failed.")
+    return candidates
+
+async def generate_first_valid_candidate(prompt: str, response_model: Type[BaseModel], n: int,
+                                        lease: Optional[usage.UsageLease] = None) -> BaseModel:
+    """Returns the first of `n` concurrent candidates that validates; the stragglers are cancelled."""
+    results = iter_candidates(prompt, response_model, n, lease)
+    try:
+        async for result in results:
+            if "candidate" in result:
+                return result["candidate"]
+    finally:
+        # Close explicitly so the remaining tasks are cancelled now, not at GC time
+        await results.aclose()
+    raise Exception(f"All {n} candidate generations failed.")
+
+async def stream_candidates(prompt: str, response_model: Type[BaseModel], n: int, first_valid_wins: bool = False,
+                            lease: Optional[usage.UsageLease] = None) -> AsyncGenerator[bytes, None]:
+    """
+    Streams candidates over SSE as they complete.
+    With `first_valid_wins`, the stream ends after the first valid candidate.
+    """
+    results = iter_candidates(prompt, response_model, n, lease)
+    try:
+        async for result in results:
+            if "candidate" in result:
+                frame = {"index": result["index"], "seed": result["seed"], "candidate": result["candidate"].dict()}
+            else:
+                frame = result
+            yield sse_frame(frame)
+            if first_valid_wins and "candidate" in result:
+                break
+    except Exception as e:
+        print(f"An exception occurred in stream_candidates: {e}")
+        yield sse_frame({"error": str(e)})
+    finally:
+        await results.aclose()
+        yield SSE_DONE
+
+@tracing.traced("prompt.render")
+def build_expansion_prompt(request: schemas.StoryExpandRequest) -> str:
+    characters_json_str = json.dumps(request.characters, ensure_ascii=False, indent=2)
+    return PLOT_EXPANSION_PROMPT.format(
+        chapter_summary=request.chapter_summary,
+        style=request.style,
+        characters_json=characters_json_str
+    )
+
+async def stream_expand_from_ai(request: schemas.StoryExpandRequest,
+                                lease: Optional[usage.UsageLease] = None) -> AsyncGenerator[bytes, None]:
     """
     Expands a chapter summary into full text using a streaming call to the AI model.
+    With SPECULATIVE_EXPANSION, a buffered speculative result is served when available
+    and the next chapter is pre-generated once this one completes.
     """
+    ai_client = get_ai_client()
     if not ai_client:
         print("Warning: AI client not supported. Using mock stream.")
         mock_text = "（模拟流式输出）夜色深沉。宫墙高耸，烛光如溺星沉落。"
         for word in mock_text.split("。"):
             if not word: continue
-            chunk_data = {"chunk": word + "。"}
-            yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+            yield sse_chunk(word + "。")
             await asyncio.sleep(0.5)
-        yield f"data: {json.dumps({'status': 'done'})}\n\n"
+        yield SSE_DONE
         return
 
-    characters_json_str = json.dumps(request.characters, ensure_ascii=False, indent=2)
-    prompt = PLOT_EXPANSION_PROMPT.format(
-        chapter_summary=request.chapter_summary,
-        style=request.style,
-        characters_json=characters_json_str
-    )
+    prompt = build_expansion_prompt(request)
+    speculative = settings.SPECULATIVE_EXPANSION and request.chapter_id is not None
+    completed = False
 
     try:
-        async for text_chunk in ai_client.stream_generate(prompt):
-            chunk_data = {"chunk": text_chunk}
-            yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
+        monitor = await _stream_monitor(request.chapter_id) if settings.DEDUP_ENABLED else None
+        entry = speculation.claim(request.chapter_id, _prompt_key(prompt)) if speculative else None
+        if speculative:
+            trace = tracing.current()
+            if trace:
+                now = time.perf_counter()
+                trace.add("speculation.claim", now, now, "ai", hit=entry is not None)
+        source = entry.follow() if entry is not None else _live_chunks(ai_client, prompt, lease)
+        stopped = False
+        try:
+            async for text_chunk in source:
+                yield sse_chunk(text_chunk)
+                finding = _feed_monitor(monitor, text_chunk) if monitor else None
+                if finding:
+                    yield sse_frame({"warning": finding})
+                    if settings.DEDUP_ACTION == "stop":
+                        stopped = True
+                        break
+        finally:
+            # Closing the source ends the upstream request when generation is stopped early
+            await source.aclose()
+            if entry is not None and entry.task is not None and not entry.task.done():
+                entry.task.cancel()
+        if entry is not None and entry.error:
+            raise Exception(entry.error)
+        completed = not stopped
     except Exception as e:
         print(f"An exception occurred in stream_expand_from_ai: {e}")
-        error_chunk = {"error": str(e)}
-        yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
+        yield sse_frame({"error": str(e)})
     finally:
-        yield f"data: {json.dumps({'status': 'done'})}\n\n"
+        if speculative and completed:
+            await _schedule_next_chapter(request.chapter_id, request.style)
+        yield SSE_DONE
+
+async def _live_chunks(ai_client, prompt: str, lease: Optional[usage.UsageLease]) -> AsyncGenerator[str, None]:
+    speculation.foreground_started()
+    try:
+        async with upstream_slot():
+            async for text_chunk in ai_client.stream_generate(prompt, on_usage=_usage_callback(lease)):
+                yield text_chunk
+    finally:
+        speculation.foreground_finished()
+
+# --------------------------------------------------------------------------
+# 6. SPECULATIVE EXPANSION
+# --------------------------------------------------------------------------
+
+def _prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def _next_chapter_request(chapter_id: int, style: str) -> Optional[schemas.StoryExpandRequest]:
+    """
+    Builds the expansion request for the chapter after `chapter_id` from the stored
+    plan, or None if there is nothing to speculate on or the project is over its
+    token quota (speculative work skips admission, so the quota is checked here).
+    """
+    db = database.session()
+    try:
+        chapter = crud.get_chapter(db, chapter_id=chapter_id)
+        if chapter is None:
+            return None
+        next_chapter = crud.get_next_chapter(db, project_id=chapter.project_id, chapter_index=chapter.chapter_index)
+        if next_chapter is None or next_chapter.content or not (next_chapter.plan_data or {}).get("summary"):
+            return None
+        try:
+            usage.check_project_quota(chapter.project_id)
+        except (usage.QuotaExceeded, usage.UnknownProject):
+            return None
+        characters = crud.get_characters_by_project(db, project_id=chapter.project_id)
+        return schemas.StoryExpandRequest(
+            chapter_summary=next_chapter.plan_data["summary"],
+            characters=[character.data for character in characters],
+            style=style,
+            chapter_id=next_chapter.id,
+            project_id=chapter.project_id,
+        )
+    finally:
+        db.close()
+
+def project_id_for_chapter(chapter_id: int) -> Optional[int]:
+    db = database.session()
+    try:
+        chapter = crud.get_chapter(db, chapter_id=chapter_id)
+        return chapter.project_id if chapter else None
+    finally:
+        db.close()
+
+async def _speculative_chunks(prompt: str, entry: SpeculativeEntry, project_id: Optional[int]) -> AsyncGenerator[str, None]:
+    # Speculative work is accounted to the project but to no client
+    on_usage = lambda stats: usage.tracker.record(project_id, None, stats)
+    async with upstream_slot(foreground=False):
+        entry.started_at = time.monotonic()
+        async for text_chunk in get_ai_client().stream_generate(prompt, on_usage=on_usage):
+            yield text_chunk
+
+async def _schedule_next_chapter(chapter_id: int, style: str) -> None:
+    """Queues a low-priority expansion of the chapter following `chapter_id`."""
+    try:
+        request = await asyncio.to_thread(_next_chapter_request, chapter_id, style)
+    except Exception as e:
+        print(f"Could not prepare speculative expansion after chapter {chapter_id}: {e}")
+        return
+    if request is None:
+        return
+    prompt = build_expansion_prompt(request)
+    speculation.schedule(
+        request.chapter_id,
+        _prompt_key(prompt),
+        lambda entry: _speculative_chunks(prompt, entry, request.project_id),
+    )
+
+def get_speculation_stats() -> Dict[str, float]:
+    return speculation.stats()
+
+# --------------------------------------------------------------------------
+# 7. DUPLICATE DETECTION
+# --------------------------------------------------------------------------
+
+def _load_project_index(chapter_id: int) -> Optional[dedup.ProjectIndex]:
+    db = database.session()
+    try:
+        chapter = crud.get_chapter(db, chapter_id=chapter_id)
+        if chapter is None:
+            return None
+        return dedup.get_project_index(db, chapter.project_id)
+    finally:
+        db.close()
+
+def _feed_monitor(monitor: dedup.StreamMonitor, text_chunk: str) -> Optional[Dict[str, Any]]:
+    trace = tracing.current()
+    if trace is None:
+        return monitor.feed(text_chunk)
+    start = time.perf_counter()
+    finding = monitor.feed(text_chunk)
+    trace.accumulate("dedup.feed", start, time.perf_counter())
+    return finding
+
+async def _stream_monitor(chapter_id: Optional[int]) -> dedup.StreamMonitor:
+    """
+    Builds the duplicate monitor for one expansion. Without a saved chapter only
+    repetition loops are checked; with one, overlap with the project's other chapters too.
+    """
+    index = None
+    if chapter_id is not None:
+        # Sketching a project's chapters is CPU-bound; keep it off the event loop
+        with tracing.span("dedup.load_index"):
+            index = await asyncio.to_thread(_load_project_index, chapter_id)
+    return dedup.StreamMonitor(
+        index,
+        chapter_id=chapter_id,
+        overlap_threshold=settings.DEDUP_OVERLAP_THRESHOLD,
+        loop_threshold=settings.DEDUP_LOOP_THRESHOLD,
+    )
+
+def get_duplicate_report(db, project_id: int, threshold: float) -> List[Dict[str, Any]]:
+    """Similar passages across (or within) the project's saved chapters, most similar first."""
+    return dedup.get_project_index(db, project_id).report(threshold)
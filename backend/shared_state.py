@@ -0,0 +1,255 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import settings
+
+# --------------------------------------------------------------------------
+# Shared state used by the generation paths: response cache, global upstream
+# concurrency slots and windowed counters (rate limits). With several worker
+# processes, in-process dicts would be per-worker, so the backend is pluggable.
+# --------------------------------------------------------------------------
+
+class SharedStateBackend(ABC):
+    """Interface for state shared between requests (and possibly worker processes)."""
+
+    # True when calls may block on I/O or on locks held by other processes;
+    # async code then runs them in a thread (see call() below).
+    blocking = False
+
+    @abstractmethod
+    def cache_get(self, key: str) -> Optional[Any]:
+        """Returns the cached JSON-serializable value, or None if missing or expired."""
+
+    @abstractmethod
+    def cache_set(self, key: str, value: Any, ttl: float) -> None:
+        """Stores a JSON-serializable value for `ttl` seconds."""
+
+    @abstractmethod
+    def try_acquire(self, name: str, limit: int, lease_seconds: float) -> Optional[str]:
+        """
+        Takes one of `limit` slots named `name` without blocking.
+        Returns a token for release(), or None if all slots are taken.
+        Slots expire after `lease_seconds` so a crashed worker cannot leak them.
+        """
+
+    @abstractmethod
+    def renew(self, name: str, token: str, lease_seconds: float) -> bool:
+        """Extends a held slot's lease; returns False if the slot has already expired."""
+
+    @abstractmethod
+    def release(self, name: str, token: str) -> None:
+        """Returns a slot taken with try_acquire()."""
+
+    @abstractmethod
+    def incr_window(self, key: str, amount: int, window_seconds: int) -> int:
+        """Adds `amount` to the counter for the current fixed window and returns the new total."""
+
+
+class LocalStateBackend(SharedStateBackend):
+    """In-process backend. Correct only when the API runs as a single worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Tuple[float, Any]] = {}
+        self._slots: Dict[str, Dict[str, float]] = {}
+        self._counters: Dict[Tuple[str, int], int] = {}
+
+    def cache_get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._cache[key]
+                return None
+            return value
+
+    def cache_set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._cache[key] = (time.time() + ttl, value)
+
+    def try_acquire(self, name: str, limit: int, lease_seconds: float) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            holders = self._slots.setdefault(name, {})
+            for token, expires_at in list(holders.items()):
+                if expires_at < now:
+                    del holders[token]
+            if len(holders) >= limit:
+                return None
+            token = uuid.uuid4().hex
+            holders[token] = now + lease_seconds
+            return token
+
+    def renew(self, name: str, token: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            holders = self._slots.get(name, {})
+            if holders.get(token, 0) < now:
+                holders.pop(token, None)
+                return False
+            holders[token] = now + lease_seconds
+            return True
+
+    def release(self, name: str, token: str) -> None:
+        with self._lock:
+            self._slots.get(name, {}).pop(token, None)
+
+    def incr_window(self, key: str, amount: int, window_seconds: int) -> int:
+        window = int(time.time() // window_seconds)
+        with self._lock:
+            for stale in [k for k in self._counters if k[0] == key and k[1] < window]:
+                del self._counters[stale]
+            total = self._counters.get((key, window), 0) + amount
+            self._counters[(key, window)] = total
+            return total
+
+
+class SQLiteStateBackend(SharedStateBackend):
+    """
+    Cross-process backend on a local SQLite file (WAL mode).
+    Every mutation runs in a BEGIN IMMEDIATE transaction, which serializes
+    writers across processes, so slot and counter updates are atomic.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS slots (name TEXT NOT NULL, token TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_slots_name ON slots (name)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT NOT NULL, window INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (key, window))")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def cache_get(self, key: str) -> Optional[Any]:
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def cache_set(self, key: str, value: Any, ttl: float) -> None:
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl),
+            )
+
+    def try_acquire(self, name: str, limit: int, lease_seconds: float) -> Optional[str]:
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slots WHERE name = ? AND expires_at < ?", (name, now))
+            (held,) = conn.execute("SELECT COUNT(*) FROM slots WHERE name = ?", (name,)).fetchone()
+            if held >= limit:
+                return None
+            token = uuid.uuid4().hex
+            conn.execute("INSERT INTO slots (name, token, expires_at) VALUES (?, ?, ?)", (name, token, now + lease_seconds))
+            return token
+
+    def renew(self, name: str, token: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE slots SET expires_at = ? WHERE name = ? AND token = ? AND expires_at >= ?",
+                (now + lease_seconds, name, token, now),
+            ).rowcount
+            return updated == 1
+
+    def release(self, name: str, token: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM slots WHERE name = ? AND token = ?", (name, token))
+
+    def incr_window(self, key: str, amount: int, window_seconds: int) -> int:
+        window = int(time.time() // window_seconds)
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM counters WHERE key = ? AND window < ?", (key, window))
+            conn.execute(
+                "INSERT INTO counters (key, window, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (key, window) DO UPDATE SET count = count + excluded.count",
+                (key, window, amount),
+            )
+            (total,) = conn.execute("SELECT count FROM counters WHERE key = ? AND window = ?", (key, window)).fetchone()
+            return total
+
+
+STATE_BACKENDS = {
+    "local": lambda: LocalStateBackend(),
+    "sqlite": lambda: SQLiteStateBackend(os.path.abspath(settings.SHARED_STATE_PATH)),
+}
+
+_state_backend: Optional[SharedStateBackend] = None
+_state_backend_lock = threading.Lock()
+
+def get_state_backend() -> SharedStateBackend:
+    """Returns the configured shared state backend, building it on first use."""
+    global _state_backend
+    if _state_backend is None:
+        with _state_backend_lock:
+            if _state_backend is None:
+                factory = STATE_BACKENDS.get(settings.SHARED_STATE_BACKEND)
+                if factory is None:
+                    raise ValueError(f"Unknown SHARED_STATE_BACKEND '{settings.SHARED_STATE_BACKEND}'")
+                _state_backend = factory()
+    return _state_backend
+
+
+# --------------------------------------------------------------------------
+# Async helpers
+# --------------------------------------------------------------------------
+
+async def call(func: Callable, *args: Any) -> Any:
+    """
+    Calls `func`, which uses the state backend, from async code. With a blocking
+    backend it runs in a thread, so a contended SQLite lock does not stall the event loop.
+    """
+    if get_state_backend().blocking:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+
+def start_heartbeat(name: str, token: str, lease_seconds: float) -> asyncio.Task:
+    """
+    Renews a held slot every third of its lease until the returned task is
+    cancelled, so a slot held by a long generation does not expire and get
+    handed to another request. Cancel the task before releasing the slot.
+    """
+    async def renew_forever():
+        state = get_state_backend()
+        while True:
+            await asyncio.sleep(lease_seconds / 3)
+            if not await call(state.renew, name, token, lease_seconds):
+                print(f"Lease on slot '{name}' expired before it could be renewed.")
+                return
+    return asyncio.create_task(renew_forever())
@@ -0,0 +1,181 @@
+import asyncio
+import time
+from typing import AsyncGenerator, Callable, Dict, List, Optional
+
+# --------------------------------------------------------------------------
+# Speculative pre-generation of the next chapter.
+#
+# When a chapter expansion finishes, the expansion of the following chapter is
+# started in the background while the provider is otherwise idle. Its chunks
+# are buffered in a SpeculativeEntry; a later request for that chapter with the
+# same prompt replays the buffer and then follows the live generation.
+#
+# Entries are keyed by the hash of the prompt they were generated from, so a
+# change that reaches the next chapter's prompt (its plan, the characters or the
+# style) makes the entry a miss; saving the previous chapter's text does not.
+#
+# Speculation never makes a user wait: it only starts while no foreground
+# generation is in flight, and a running one is cancelled (preempted) as soon
+# as a foreground request has to wait for a provider slot.
+#
+# Entries live in the worker process that produced them. With several workers,
+# a request routed to another worker is simply a miss.
+# --------------------------------------------------------------------------
+
+class SpeculativeEntry:
+    """Buffered output of one speculative expansion."""
+
+    def __init__(self, chapter_id: int, key: str):
+        self.chapter_id = chapter_id
+        self.key = key
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.created_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    def append(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._changed.set()
+
+    def finish(self, error: Optional[str] = None) -> None:
+        self.error = error
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._changed.set()
+
+    def generation_seconds(self) -> float:
+        """Wall time spent generating, used as the GPU time estimate."""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    async def follow(self) -> AsyncGenerator[str, None]:
+        """Yields every buffered chunk from the start, then new chunks until done."""
+        offset = 0
+        while True:
+            self._changed.clear()
+            while offset < len(self.chunks):
+                yield self.chunks[offset]
+                offset += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class SpeculationManager:
+    """Schedules, serves and preempts speculative expansions for one worker."""
+
+    def __init__(self, max_entries: int = 4, idle_poll_seconds: float = 0.5):
+        self.max_entries = max_entries
+        self.idle_poll_seconds = idle_poll_seconds
+        self.entries: Dict[int, SpeculativeEntry] = {}
+        # Foreground generations in flight; speculation only starts when this is 0
+        self.foreground = 0
+        self.scheduled = 0
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.preempted = 0
+        self.wasted_seconds = 0.0
+        self.served_seconds = 0.0
+
+    def foreground_started(self) -> None:
+        self.foreground += 1
+
+    def foreground_finished(self) -> None:
+        self.foreground -= 1
+
+    def schedule(
+        self,
+        chapter_id: int,
+        key: str,
+        producer: Callable[[SpeculativeEntry], AsyncGenerator[str, None]],
+    ) -> None:
+        """
+        Starts a background expansion of `chapter_id` unless one with the same key exists.
+        `producer(entry)` yields the text chunks and sets `entry.started_at` when
+        generation actually begins; it runs only once no foreground generation
+        is in flight.
+        """
+        existing = self.entries.get(chapter_id)
+        if existing is not None:
+            if existing.key == key:
+                return
+            self._discard(existing)
+
+        while len(self.entries) >= self.max_entries:
+            oldest = min(self.entries.values(), key=lambda entry: entry.created_at)
+            self._discard(oldest)
+
+        entry = SpeculativeEntry(chapter_id, key)
+        entry.task = asyncio.create_task(self._run(entry, producer))
+        self.entries[chapter_id] = entry
+        self.scheduled += 1
+
+    async def _run(self, entry: SpeculativeEntry, producer) -> None:
+        try:
+            while self.foreground > 0:
+                await asyncio.sleep(self.idle_poll_seconds)
+            async for chunk in producer(entry):
+                entry.append(chunk)
+            entry.finish()
+        except asyncio.CancelledError:
+            entry.finish(error="cancelled")
+            raise
+        except Exception as e:
+            print(f"Speculative expansion of chapter {entry.chapter_id} failed: {e}")
+            entry.finish(error=str(e))
+
+    def claim(self, chapter_id: int, key: str) -> Optional[SpeculativeEntry]:
+        """
+        Returns the entry for `chapter_id` if it was generated from the same prompt,
+        removing it from the buffer. A stale entry is discarded, and so is one that
+        has not started: it would wait behind other generations at idle priority,
+        so the request is better served live.
+        """
+        entry = self.entries.get(chapter_id)
+        if entry is None or entry.key != key or entry.started_at is None or (entry.done and entry.error):
+            if entry is not None:
+                self._discard(entry)
+            self.misses += 1
+            return None
+        del self.entries[chapter_id]
+        self.hits += 1
+        self.served_seconds += entry.generation_seconds()
+        return entry
+
+    def preempt(self) -> int:
+        """
+        Cancels the speculative generations that are running, so the provider
+        slots they hold go to a waiting foreground request. Returns how many.
+        """
+        running = [entry for entry in self.entries.values() if entry.started_at is not None and not entry.done]
+        for entry in running:
+            self._discard(entry)
+        self.preempted += len(running)
+        return len(running)
+
+    def _discard(self, entry: SpeculativeEntry) -> None:
+        self.entries.pop(entry.chapter_id, None)
+        if entry.task is not None and not entry.task.done():
+            entry.task.cancel()
+        self.discarded += 1
+        self.wasted_seconds += entry.generation_seconds()
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            "scheduled": self.scheduled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "discarded": self.discarded,
+            "preempted": self.preempted,
+            "buffered": len(self.entries),
+            "served_generation_seconds": round(self.served_seconds, 3),
+            "wasted_generation_seconds": round(self.wasted_seconds, 3),
+        }
@@ -0,0 +1,442 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import io
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from config import settings
+
+# pyinstrument is optional; cProfile is always available
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+except ImportError:  # pragma: no cover - depends on the environment
+    PyinstrumentProfiler = None
+
+# --------------------------------------------------------------------------
+# Opt-in request tracing.
+#
+# With TRACING_ENABLED, a request is traced when it carries `X-Trace: 1` or is
+# picked by TRACE_SAMPLE_RATE. The active Trace lives in a context variable, so
+# span() and traced() anywhere in the request path (services, crud, SSE
+# encoding) record into it, and cost one lookup when nothing is traced.
+#
+# Traces are kept in memory for the debug endpoints; those slower than
+# TRACE_SLOW_THRESHOLD_MS are also appended to TRACE_FILE in the Chrome trace
+# event format (open in chrome://tracing or ui.perfetto.dev). Each worker
+# process writes its own file, with its pid inserted before the extension.
+# --------------------------------------------------------------------------
+
+TRACE_HEADER = b"x-trace"
+TRACE_ID_HEADER = b"x-trace-id"
+RECENT_TRACES = 50
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+_profile: contextvars.ContextVar[Optional["_Profile"]] = contextvars.ContextVar("profile", default=None)
+
+
+class Trace:
+    """Spans of one request, as Chrome trace events."""
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.wall_start_us = time.time_ns() // 1000
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.finished = False
+        self.events: List[Dict[str, Any]] = []
+        self.profile: Optional[str] = None
+        # name -> [first start, total seconds, calls] for per-chunk work
+        self._aggregates: Dict[str, List[float]] = {}
+        self._lanes: Dict[Tuple[int, int], int] = {}
+        self._lock = threading.Lock()
+
+    def _lane(self) -> int:
+        """One timeline row per thread and asyncio task, so concurrent spans don't overlap."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = (threading.get_ident(), id(task) if task is not None else 0)
+        with self._lock:
+            return self._lanes.setdefault(key, len(self._lanes) + 1)
+
+    def _ts(self, at: float) -> float:
+        return self.wall_start_us + (at - self.start) * 1e6
+
+    def add(self, name: str, start: float, end: float, category: str = "app", **args: Any) -> None:
+        """Records a span between two time.perf_counter() readings."""
+        if self.finished:
+            # Work that outlives its request (e.g. a speculative task) is not part of it
+            return
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": round(self._ts(start), 1), "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(), "tid": self._lane(),
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def accumulate(self, name: str, start: float, end: float) -> None:
+        """Adds to a span reported once per trace as total time and call count."""
+        if self.finished:
+            return
+        with self._lock:
+            total = self._aggregates.setdefault(name, [start, 0.0, 0])
+            total[1] += end - start
+            total[2] += 1
+
+    def finish(self, **args: Any) -> None:
+        end = time.perf_counter()
+        self.add(self.name, self.start, end, category="request", **args)
+        self.finished = True
+        self.duration = end - self.start
+        for name, (first, total, calls) in self._aggregates.items():
+            self.events.append({
+                "name": name, "cat": "aggregate", "ph": "X",
+                "ts": round(self._ts(first), 1), "dur": round(total * 1e6, 1),
+                "pid": os.getpid(), "tid": 0, "args": {"calls": calls, "total_ms": round(total * 1000, 3)},
+            })
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "duration_ms": round(self.duration * 1000, 3),
+            "slow": self.duration * 1000 >= settings.TRACE_SLOW_THRESHOLD_MS,
+            "spans": len(self.events),
+            "profiled": self.profile is not None,
+        }
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+# --------------------------------------------------------------------------
+# Recording helpers
+# --------------------------------------------------------------------------
+
+class _Span:
+    __slots__ = ("trace", "name", "category", "args", "start")
+
+    def __init__(self, trace: Trace, name: str, category: str, args: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.trace.add(self.name, self.start, time.perf_counter(), self.category, **self.args)
+
+
+class _NoSpan:
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+_NO_SPAN = _NoSpan()
+
+def span(name: str, category: str = "app", **args: Any):
+    """`with span("stage"):` records the block when the request is traced."""
+    trace = _current.get()
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, category, args)
+
+
+def traced(name: Optional[str] = None, category: str = "app") -> Callable:
+    """Decorator recording each call of a synchronous function as a span."""
+    def decorator(func: Callable) -> Callable:
+        span_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(span_name, start, time.perf_counter(), category)
+        return wrapper
+    return decorator
+
+
+def request_extensions() -> Dict[str, Any]:
+    """
+    httpx request extensions that record connection setup, the request write and
+    the wait for response headers as spans; empty when not tracing.
+    """
+    trace = _current.get()
+    if trace is None:
+        return {}
+    started: Dict[str, float] = {}
+
+    async def callback(event_name: str, info: Dict[str, Any]) -> None:
+        stage, _, phase = event_name.rpartition(".")
+        if phase == "started":
+            started[stage] = time.perf_counter()
+        elif phase in ("complete", "failed") and stage in started:
+            trace.add(f"http.{stage}", started.pop(stage), time.perf_counter(), "http")
+    return {"trace": callback}
+
+# --------------------------------------------------------------------------
+# Storage: recent traces, slow trace file, profiles
+# --------------------------------------------------------------------------
+
+_recent: Deque[Trace] = deque(maxlen=RECENT_TRACES)
+_slow_logger: Optional[logging.Logger] = None
+_slow_logger_lock = threading.Lock()
+
+
+class _TraceFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file in the Chrome JSON array format. Each file starts with "[" and
+    every event line ends with ","; trace viewers accept the unterminated array.
+    """
+
+    def _open(self):
+        stream = super()._open()
+        if stream.tell() == 0:
+            stream.write("[\n")
+        return stream
+
+
+def trace_file_path() -> str:
+    """TRACE_FILE for this process; workers can't share a rotating file."""
+    root, ext = os.path.splitext(settings.TRACE_FILE)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+def _get_slow_logger() -> logging.Logger:
+    global _slow_logger
+    if _slow_logger is None:
+        with _slow_logger_lock:
+            if _slow_logger is None:
+                path = trace_file_path()
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                handler = _TraceFileHandler(
+                    path,
+                    maxBytes=settings.TRACE_FILE_MAX_BYTES,
+                    backupCount=settings.TRACE_FILE_BACKUPS,
+                    encoding="utf-8",
+                )
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger = logging.getLogger("novelaicreator.slow_traces")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(handler)
+                _slow_logger = logger
+    return _slow_logger
+
+
+def store(trace: Trace) -> None:
+    """Keeps a finished trace for the debug endpoints and writes it out if slow."""
+    _recent.append(trace)
+    if trace.duration * 1000 < settings.TRACE_SLOW_THRESHOLD_MS:
+        return
+    lines = ",\n".join(json.dumps(event, ensure_ascii=False, separators=(",", ":")) for event in trace.events)
+    try:
+        _get_slow_logger().info(lines + ",")
+    except OSError as e:
+        print(f"Failed to write slow trace {trace.trace_id}: {e}")
+
+
+def recent_traces() -> List[Dict[str, Any]]:
+    return [trace.summary() for trace in reversed(_recent)]
+
+
+def get_trace(trace_id: str) -> Optional[Trace]:
+    for trace in _recent:
+        if trace.trace_id == trace_id:
+            return trace
+    return None
+
+
+class _Profile:
+    """
+    Profiles the event loop thread while one traced request runs (one at a time;
+    cProfile cannot nest). Other requests interleaved on the loop show up too.
+    With cProfile, work the request hands to worker threads is profiled as well
+    (see install_thread_profiling()); pyinstrument only samples the loop thread.
+    """
+
+    _active = threading.Lock()
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.profiler = None
+        self.thread_profilers = []
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        if not self._active.acquire(blocking=False):
+            return False
+        try:
+            if self.kind == "pyinstrument" and PyinstrumentProfiler is not None:
+                self.profiler = PyinstrumentProfiler(async_mode="enabled")
+                self.profiler.start()
+            else:
+                import cProfile
+                self.kind = "cprofile"
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        except Exception as e:
+            print(f"Could not start the {self.kind} profiler: {e}")
+            self._active.release()
+            return False
+        return True
+
+    def wrap(self, func: Callable) -> Callable:
+        """Runs `func` under its own cProfile profiler, merged into this profile by stop()."""
+        import cProfile
+
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler owns the interpreter (sys.monitoring, 3.12+)
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                with self._lock:
+                    self.thread_profilers.append(profiler)
+        return profiled
+
+    def stop(self) -> str:
+        try:
+            if self.kind == "pyinstrument":
+                self.profiler.stop()
+                return self.profiler.output_text(unicode=True)
+            import pstats
+            self.profiler.disable()
+            out = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=out)
+            with self._lock:
+                # Thread work still running now is left out
+                for profiler in self.thread_profilers:
+                    stats.add(profiler)
+                if self.thread_profilers:
+                    out.write(f"Includes {len(self.thread_profilers)} call(s) run in worker threads.\n\n")
+            stats.sort_stats("cumulative").print_stats(60)
+            return out.getvalue()
+        finally:
+            self._active.release()
+
+
+def _profiled_in_thread(func: Callable) -> Callable:
+    """Wraps `func` before it is handed to a worker thread if the request is being profiled."""
+    profile = _profile.get()
+    if profile is None or profile.kind != "cprofile":
+        return func
+    return profile.wrap(func)
+
+
+class _ProfilingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Default executor (asyncio.to_thread, run_in_executor) that profiles profiled requests' work."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(_profiled_in_thread(fn), *args, **kwargs)
+
+
+_thread_profiling_installed = False
+
+def install_thread_profiling() -> None:
+    """
+    Before Python 3.12, cProfile only sees the thread it was enabled on. With
+    TRACE_PROFILER=cprofile, this routes the two thread pools the app uses
+    (asyncio's default executor and anyio's, which runs FastAPI's sync endpoints
+    and dependencies) through _profiled_in_thread. From 3.12, cProfile runs on
+    sys.monitoring, which covers every thread and allows only one profiler at a
+    time, so nothing is installed. Call from the event loop at startup.
+    """
+    global _thread_profiling_installed
+    if _thread_profiling_installed or not settings.TRACING_ENABLED or settings.TRACE_PROFILER != "cprofile":
+        return
+    if sys.version_info >= (3, 12):
+        return
+    _thread_profiling_installed = True
+    asyncio.get_running_loop().set_default_executor(_ProfilingExecutor(thread_name_prefix="asyncio"))
+
+    import anyio.to_thread
+    run_sync = anyio.to_thread.run_sync
+
+    @functools.wraps(run_sync)
+    async def profiled_run_sync(func, *args, **kwargs):
+        return await run_sync(_profiled_in_thread(func), *args, **kwargs)
+    anyio.to_thread.run_sync = profiled_run_sync
+
+# --------------------------------------------------------------------------
+# ASGI middleware
+# --------------------------------------------------------------------------
+
+def _should_trace(headers: List[Tuple[bytes, bytes]]) -> bool:
+    if not settings.TRACING_ENABLED:
+        return False
+    for key, value in headers:
+        if key == TRACE_HEADER:
+            return value.strip() not in (b"", b"0", b"false")
+    return settings.TRACE_SAMPLE_RATE > 0 and random.random() < settings.TRACE_SAMPLE_RATE
+
+
+class TracingMiddleware:
+    """
+    Traces sampled HTTP requests end to end, including the body of streaming
+    responses, and returns the trace id in an X-Trace-Id header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_trace(scope.get("headers", [])):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        status = {"code": 500}
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = [*message.get("headers", []), (TRACE_ID_HEADER, trace.trace_id.encode())]
+            await send(message)
+
+        profile = _Profile(settings.TRACE_PROFILER) if settings.TRACE_PROFILER else None
+        if profile is not None and not profile.start():
+            profile = None
+        token = _current.set(trace)
+        profile_token = _profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            _profile.reset(profile_token)
+            _current.reset(token)
+            if profile is not None:
+                trace.profile = profile.stop()
+            trace.finish(status=status["code"])
+            await asyncio.to_thread(store, trace)
@@ -0,0 +1,246 @@
+import asyncio
+import threading
+from typing import Dict, Optional
+
+from sqlalchemy.exc import IntegrityError
+
+import crud, database, shared_state
+from config import settings
+from shared_state import get_state_backend
+
+# --------------------------------------------------------------------------
+# Token accounting and quotas.
+#
+# Usage reported by the AI provider is aggregated in memory per project and
+# written to the project_usage table in batches (every USAGE_FLUSH_INTERVAL_SECONDS
+# or USAGE_FLUSH_BATCH records), so requests never wait on an accounting commit.
+# Quotas are checked when a request is admitted, before it queues for the provider.
+#
+# Requests name the project they are accounted to. While a project quota is
+# enabled, a request without one is rejected; otherwise its usage is counted
+# only against the client quotas.
+# --------------------------------------------------------------------------
+
+CLIENT_TOKEN_WINDOW_SECONDS = 3600
+
+USAGE_COLUMNS = (
+    "requests",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_duration_ns",
+    "prompt_eval_duration_ns",
+    "eval_duration_ns",
+)
+
+class QuotaExceeded(Exception):
+    """Raised when a project or client is over a token or concurrency quota."""
+
+
+class UnknownProject(Exception):
+    """Raised when a request is accounted to a project that does not exist."""
+
+
+class ProjectRequired(Exception):
+    """Raised when a request names no project while project quotas are enabled."""
+
+
+def _usage_delta(stats: Dict[str, int]) -> Dict[str, int]:
+    """Maps Ollama's usage fields onto the project_usage columns."""
+    return {
+        "requests": 1,
+        "prompt_tokens": stats.get("prompt_eval_count", 0),
+        "completion_tokens": stats.get("eval_count", 0),
+        "total_duration_ns": stats.get("total_duration", 0),
+        "prompt_eval_duration_ns": stats.get("prompt_eval_duration", 0),
+        "eval_duration_ns": stats.get("eval_duration", 0),
+    }
+
+
+class UsageTracker:
+    """In-memory per-project usage aggregates, flushed to the database in batches."""
+
+    def __init__(self, flush_interval: float, flush_batch: int):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Dict[str, int]] = {}
+        self._pending_records = 0
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def record(self, project_id: Optional[int], client_id: Optional[str], stats: Dict[str, int]) -> None:
+        tokens = stats.get("prompt_eval_count", 0) + stats.get("eval_count", 0)
+        if client_id is not None and settings.CLIENT_TOKEN_QUOTA_PER_HOUR > 0:
+            _count_client_tokens(client_id, tokens)
+        if project_id is None:
+            return
+        with self._lock:
+            totals = self._pending.setdefault(project_id, {})
+            for field, value in _usage_delta(stats).items():
+                totals[field] = totals.get(field, 0) + value
+            self._pending_records += 1
+            full = self._pending_records >= self.flush_batch
+        if full and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending_for(self, project_id: int) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._pending.get(project_id, {}))
+
+    def flush(self) -> None:
+        """Writes all pending aggregates in one transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_records = 0
+        if not pending:
+            return
+        db = database.session()
+        try:
+            try:
+                crud.add_project_usage(db, pending)
+            except IntegrityError:
+                # Another worker created one of the rows first; the retry updates it
+                db.rollback()
+                crud.add_project_usage(db, pending)
+        except Exception as e:
+            print(f"Failed to flush usage aggregates, keeping them for the next flush: {e}")
+            db.rollback()
+            with self._lock:
+                for project_id, delta in pending.items():
+                    totals = self._pending.setdefault(project_id, {})
+                    for field, value in delta.items():
+                        totals[field] = totals.get(field, 0) + value
+        finally:
+            db.close()
+
+    async def run(self) -> None:
+        """Background flush loop, started from the app lifespan."""
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await asyncio.to_thread(self.flush)
+        finally:
+            self._wakeup = None
+
+
+tracker = UsageTracker(settings.USAGE_FLUSH_INTERVAL_SECONDS, settings.USAGE_FLUSH_BATCH)
+
+
+def _count_client_tokens(client_id: str, tokens: int) -> None:
+    state = get_state_backend()
+    args = (f"tokens:{client_id}", tokens, CLIENT_TOKEN_WINDOW_SECONDS)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if state.blocking and loop is not None:
+        # Usage callbacks run on the event loop; don't wait there on the shared lock
+        loop.run_in_executor(None, state.incr_window, *args)
+    else:
+        state.incr_window(*args)
+
+
+class UsageLease:
+    """
+    An admitted generation request. Holds its concurrency slots until release()
+    and attributes reported usage to its project and client.
+    """
+
+    def __init__(self, project_id: Optional[int], client_id: str):
+        self.project_id = project_id
+        self.client_id = client_id
+        self._slots = []
+        self._heartbeats = []
+
+    def record(self, stats: Dict[str, int]) -> None:
+        tracker.record(self.project_id, self.client_id, stats)
+
+    def take_slot(self, name: str, limit: int, description: str) -> None:
+        token = get_state_backend().try_acquire(name, limit, settings.UPSTREAM_SLOT_LEASE_SECONDS)
+        if token is None:
+            raise QuotaExceeded(f"{description} already has {limit} generation requests in flight.")
+        self._slots.append((name, token))
+
+    def keep_alive(self) -> None:
+        """Renews the held slots until release(); call on the event loop once admitted."""
+        self._heartbeats = [
+            shared_state.start_heartbeat(name, token, settings.UPSTREAM_SLOT_LEASE_SECONDS)
+            for name, token in self._slots
+        ]
+
+    def release_slots(self) -> None:
+        state = get_state_backend()
+        for name, token in self._slots:
+            state.release(name, token)
+        self._slots = []
+
+    async def release(self) -> None:
+        for heartbeat in self._heartbeats:
+            heartbeat.cancel()
+        self._heartbeats = []
+        if self._slots:
+            await shared_state.call(self.release_slots)
+
+
+def _project_quotas_enabled() -> bool:
+    return settings.PROJECT_TOKEN_QUOTA > 0 or settings.PROJECT_CONCURRENCY_LIMIT > 0
+
+
+def _project_tokens_used(db, project_id: int) -> int:
+    row = crud.get_project_usage(db, project_id=project_id)
+    persisted = (row.prompt_tokens + row.completion_tokens) if row else 0
+    pending = tracker.pending_for(project_id)
+    return persisted + pending.get("prompt_tokens", 0) + pending.get("completion_tokens", 0)
+
+
+def check_project_quota(project_id: int) -> None:
+    """Raises UnknownProject or QuotaExceeded. Queries the database; call it from a thread."""
+    db = database.session()
+    try:
+        if crud.get_project(db, project_id=project_id) is None:
+            raise UnknownProject(f"Project {project_id} not found")
+        if settings.PROJECT_TOKEN_QUOTA > 0 and _project_tokens_used(db, project_id) >= settings.PROJECT_TOKEN_QUOTA:
+            raise QuotaExceeded(f"Project {project_id} has used its token quota of {settings.PROJECT_TOKEN_QUOTA}.")
+    finally:
+        db.close()
+
+
+def admit(project_id: Optional[int], client_id: str) -> UsageLease:
+    """
+    Checks the project and the token quotas and takes the concurrency slots for
+    one request. Raises UnknownProject, ProjectRequired or QuotaExceeded.
+    Quotas set to 0 are disabled. Blocks on the database and the state backend,
+    so async callers run it in a thread.
+    """
+    if project_id is not None:
+        check_project_quota(project_id)
+    elif _project_quotas_enabled():
+        raise ProjectRequired("project_id is required while project quotas are enabled.")
+    if settings.CLIENT_TOKEN_QUOTA_PER_HOUR > 0:
+        used = get_state_backend().incr_window(f"tokens:{client_id}", 0, CLIENT_TOKEN_WINDOW_SECONDS)
+        if used >= settings.CLIENT_TOKEN_QUOTA_PER_HOUR:
+            raise QuotaExceeded(f"Token quota of {settings.CLIENT_TOKEN_QUOTA_PER_HOUR} per hour exceeded.")
+
+    lease = UsageLease(project_id, client_id)
+    try:
+        if project_id is not None and settings.PROJECT_CONCURRENCY_LIMIT > 0:
+            lease.take_slot(f"project:{project_id}", settings.PROJECT_CONCURRENCY_LIMIT, f"Project {project_id}")
+        if settings.CLIENT_CONCURRENCY_LIMIT > 0:
+            lease.take_slot(f"client:{client_id}", settings.CLIENT_CONCURRENCY_LIMIT, "This client")
+    except QuotaExceeded:
+        lease.release_slots()
+        raise
+    return lease
+
+
+def get_project_usage(db, project_id: int) -> Dict[str, int]:
+    """Persisted usage plus the aggregates not flushed yet."""
+    row = crud.get_project_usage(db, project_id=project_id)
+    usage = {field: (getattr(row, field) or 0) if row is not None else 0 for field in USAGE_COLUMNS}
+    for field, value in tracker.pending_for(project_id).items():
+        usage[field] += value
+    return usage
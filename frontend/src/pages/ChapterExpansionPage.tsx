@@ -59,6 +59,8 @@ export const ChapterExpansionPage: React.FC = () => {
         chapter_summary: chapterSummary,
         characters: characters.map(char => char.data), // Send only data part
         style: currentStyle,
+        chapter_id: selectedChapterId,
+        project_id: projectIdNum,
       };
       const stream = await streamExpandStory(request);
 
@@ -60,6 +60,7 @@ export const ChapterPlanningPage: React.FC = () => {
       const request: ChapterPlanRequest = {
         outline: currentProject.story_outline.data, // Use the saved story outline
         chapter_count: values.chapter_count,
+        project_id: projectIdNum,
       };
       const response = await generateChapterPlan(request);
       setGeneratedChapterPlan(response);
@@ -36,7 +36,8 @@ export const CharacterGenerationPage: React.FC = () => { // Changed to named exp
       const request: CharacterGenerateRequest = {
         theme: values.theme,
         prompt_question: values.prompt_question,
-        options: {}, // projectId context passed via path, not needed here directly
+        options: {},
+        project_id: projectIdNum, // Usage and quotas are accounted to the project
       };
       const response = await generateCharacter(request);
       setGeneratedCharacter(response);
@@ -68,6 +68,7 @@ export const StoryOutlinePage: React.FC = () => {
         theme: values.theme,
         style: values.style,
         characters: charactersForRequest,
+        project_id: projectIdNum,
       };
       const response = await generateStoryOutline(request);
       setGeneratedOutline(response);
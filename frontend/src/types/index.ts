@@ -2,27 +2,38 @@
 // API Request Schemas (from backend/schemas.py)
 // ====================================================================
 
-export interface CharacterGenerateRequest {
+export interface CandidateOptions {
+  n?: number; // Number of concurrent candidates (1-8)
+  first_valid_wins?: boolean;
+  stream?: boolean;
+}
+
+export interface CharacterGenerateRequest extends CandidateOptions {
   theme: string;
   prompt_question: string;
   options?: Record<string, any>; // Optional dictionary
+  project_id?: number; // Project the generation is accounted to (required while project quotas are set)
 }
 
-export interface StoryOutlineRequest {
+export interface StoryOutlineRequest extends CandidateOptions {
   theme: string;
   style: string;
   characters: Array<Record<string, any>>; // Array of character data
+  project_id?: number;
 }
 
-export interface ChapterPlanRequest {
+export interface ChapterPlanRequest extends CandidateOptions {
   outline: Record<string, any>; // StoryOutlineResponse structure
   chapter_count: number;
+  project_id?: number;
 }
 
 export interface StoryExpandRequest {
   chapter_summary: string;
   characters: Array<Record<string, any>>; // Array of character data
   style: string;
+  chapter_id?: number; // Saved chapter being expanded (enables speculative expansion)
+  project_id?: number; // Defaults to the chapter's project
 }
 
 // ====================================================================